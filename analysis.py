@@ -1,10 +1,11 @@
 """Creates entity cooccurrence tables"""
 
+import array
 import codecs
+import heapq
 import inspect
 import itertools
-import json
-from lxml import etree
+import operator
 import os
 import string
 import sys
@@ -16,11 +17,13 @@ here = os.path.dirname(os.path.abspath(
 sys.path.append(here)
 
 import config as cfg
-import clients
+import jsoncodec
 import model as md
+import services
 import utils
 
 
+etree = utils.LazyModule("lxml.etree")
 myutils = utils.Utils(cfg)
 
 
@@ -32,8 +35,12 @@ class CorpusMgr(object):
 
     @staticmethod
     def create_mention_key(fn, start, end):
-        """Create a key for the L{model.Corpus} mention-hash"""
-        return u"{}###{}###{}".format(os.path.splitext(fn)[0], start, end)
+        """
+        Create a key for the L{model.Corpus} mention-hash: a
+        (doc id, start, end) tuple. For its string form see
+        L{model.Mention.format_key}
+        """
+        return os.path.splitext(fn)[0], int(start), int(end)
 
 
 class AnnotationParser(object):
@@ -46,7 +53,7 @@ class AnnotationParser(object):
         pass
 
     @staticmethod
-    def parse(fn, cl, resp, cpsob, text=None):
+    def parse(fn, cl, resp, cpsob, text=None, offset=0):
         """
         Parse the annotations into L{model.Annotation} using the method
         required by the client which produced them (from L{clients}).
@@ -56,7 +63,11 @@ class AnnotationParser(object):
         @type resp: tool-specific (see methods below), but often json
         @param cpsob: a L{model.Corpus} object
         @param text: the text that was sent to the client. Only needed for
-        L{parse_babelfy}
+        L{parse_babelfy}, the other parsers ignore it
+        @param offset: position of the text sent in the document, when it was
+        a chunk of it (see L{model.Document.find_chunks}). Added to the
+        positions in the response, so that annotations and mention keys
+        have document positions
         @return: Hash with position tuples as keys, and L{model.Annotation}
         objs as values
         @rtype: dict
@@ -67,33 +78,15 @@ class AnnotationParser(object):
             to an entity that is already in L{model.Corpus.entities}
         For now only Spotlight is adding categories on top of TagMe's
         """
-        if cl.name == cfg.TNames.TM:
-            return AnnotationParser.parse_tagme(
-                fn, cl, resp, cpsob, redo_ents=cfg.redo_ents[cl.name])
-        elif cl.name == cfg.TNames.SP:
-            return AnnotationParser.parse_spotlight(
-                fn, cl, resp, cpsob, redo_ents=cfg.redo_ents[cl.name])
-        elif cl.name == cfg.TNames.PS:
-            return AnnotationParser.parse_spotstat(
-                fn, cl, resp, cpsob, redo_ents=cfg.redo_ents[cl.name])
-        elif cl.name == cfg.TNames.WD:
-            return AnnotationParser.parse_wminer(
-                fn, cl, resp, cpsob, redo_ents=cfg.redo_ents[cl.name])
-        elif cl.name == cfg.TNames.WI:
-            return AnnotationParser.parse_wminer_remote(
-                fn, cl, resp, cpsob, redo_ents=cfg.redo_ents[cl.name])
-        elif cl.name == cfg.TNames.AI:
-            return AnnotationParser.parse_aida(
-                fn, cl, resp, cpsob, redo_ents=cfg.redo_ents[cl.name])
-        elif cl.name == cfg.TNames.RA:
-            return AnnotationParser.parse_raida(
-                fn, cl, resp, cpsob, redo_ents=cfg.redo_ents[cl.name])
-        elif cl.name == cfg.TNames.BF:
-            return AnnotationParser.parse_babelfy(fn, cl, resp, cpsob,
-                text=text, redo_ents=cfg.redo_ents[cl.name])
+        svc = services.get(cl.name)
+        if svc is None or svc.parser is None:
+            return None
+        return svc.parser(fn, cl, resp, cpsob,
+                          redo_ents=cfg.redo_ents[cl.name], offset=offset,
+                          text=text)
 
     @staticmethod
-    def parse_tagme(fn, cl, resp, cpsob, redo_ents):
+    def parse_tagme(fn, cl, resp, cpsob, redo_ents, offset=0, text=None):
         """
         See L{parse}
         """
@@ -111,7 +104,7 @@ class AnnotationParser(object):
             except KeyError:
                 continue
             surface = an["spot"]
-            start, end = an["start"], an["end"]
+            start, end = an["start"] + offset, an["end"] + offset
             mtnkey = CorpusMgr.create_mention_key(fn, start, end)
 
             cpsob.add_mention_to_corpus(mtnkey, surface)
@@ -125,7 +118,7 @@ class AnnotationParser(object):
         return anresp
 
     @staticmethod
-    def parse_spotlight(fn, cl, resp, cpsob, redo_ents):
+    def parse_spotlight(fn, cl, resp, cpsob, redo_ents, offset=0, text=None):
         """
         See L{parse}
         @note: response as returned by pyspotlight
@@ -138,8 +131,8 @@ class AnnotationParser(object):
                 cfg.MinConfs.vals[cfg.mywscheme][cl.name][cfg.myevmode]):
                 continue
             try:
-                start = an["offset"]
-                end = an["offset"] + len(unicode(an["surfaceForm"]))
+                start = an["offset"] + offset
+                end = start + len(unicode(an["surfaceForm"]))
                 surface = an["surfaceForm"]
             except KeyError:
                 print "!! KeyError for annot: {}".format(repr(an))
@@ -164,14 +157,14 @@ class AnnotationParser(object):
         return anresp
 
     @staticmethod
-    def parse_spotstat(fn, cl, resp, cpsob, redo_ents):
+    def parse_spotstat(fn, cl, resp, cpsob, redo_ents, offset=0, text=None):
         """
         See L{parse}
         """
         if not resp:
             return {}
         anresp = {}
-        jso = resp.json()
+        jso = jsoncodec.loads(resp.content)
         # annotations are in 'Resources' element of the response
         if "Resources" not in jso:
             return {}
@@ -180,8 +173,8 @@ class AnnotationParser(object):
                 cfg.MinConfs.vals[cfg.mywscheme][cl.name][cfg.myevmode]):
                 continue
             try:
-                start = an["@offset"]
-                end = int(an["@offset"]) + len(unicode(an["@surfaceForm"]))
+                start = int(an["@offset"]) + offset
+                end = start + len(unicode(an["@surfaceForm"]))
                 surface = an["@surfaceForm"]
             except KeyError:
                 print "!! KeyError for annot: {}".format(repr(an))
@@ -206,20 +199,20 @@ class AnnotationParser(object):
         return anresp
 
     @staticmethod
-    def parse_wminer(fn, cl, resp, cpsob, redo_ents):
+    def parse_wminer(fn, cl, resp, cpsob, redo_ents, offset=0, text=None):
         """
         See L{parse}
         """
         if not resp:
             return {}
         anresp = {}
-        jso = resp.json()
+        jso = jsoncodec.loads(resp.content)
         for topic in jso['spots']:
             if (cfg.use_confidence and float(topic['score']) <
                 cfg.MinConfs.vals[cfg.mywscheme][cl.name][cfg.myevmode]):
                 continue
-            start = int(topic['start'])
-            end = int(topic['end'])
+            start = int(topic['start']) + offset
+            end = int(topic['end']) + offset
             link = myutils.norm_label(topic['wikiname'])
             surface = topic['mention']
             mtnkey = CorpusMgr.create_mention_key(fn, start, end)
@@ -236,7 +229,8 @@ class AnnotationParser(object):
         return anresp
 
     @staticmethod
-    def parse_wminer_remote(fn, cl, resp, cpsob, redo_ents):
+    def parse_wminer_remote(fn, cl, resp, cpsob, redo_ents, offset=0,
+                            text=None):
         """
         See L{parse}
         @deprecated
@@ -261,6 +255,7 @@ class AnnotationParser(object):
                 end = int(ref.attrib["end"])
                 link = myutils.norm_label(topic.attrib["title"])
                 surface = srctext[start:end]
+                start, end = start + offset, end + offset
                 mtnkey = CorpusMgr.create_mention_key(fn, start, end)
 
                 cpsob.add_entity_to_corpus(link, cl.name, ref,
@@ -276,24 +271,34 @@ class AnnotationParser(object):
         return posi2topic
 
     @staticmethod
-    def parse_aida(fn, cl, resp, cpsob, redo_ents):
+    def parse_aida(fn, cl, resp, cpsob, redo_ents, offset=0, text=None):
         """
         See L{parse}
-        @type resp: json
+        @type resp: json, decoded or not
         """
         if not resp:
             return {}
+        if isinstance(resp, basestring):
+            resp = jsoncodec.loads(resp)
         anresp = {}
+        # res["mentions"] contains all info i store but confidence
+        # index the first mention for each entity, in one pass
+        ent2mention = {}
+        for ann in resp["mentions"]:
+            kbid = ann.get("bestEntity", {}).get("kbIdentifier")
+            if kbid is not None and kbid not in ent2mention:
+                ent2mention[kbid] = ann
         entlist = resp["allEntities"]
         for ent in entlist:
             if (cfg.use_confidence and
                 float(resp[u"entityMetadata"][ent]["importance"]) <
                 cfg.MinConfs.vals[cfg.mywscheme][cl.name][cfg.myevmode]):
                 continue
-            # res["mentions"] contains all info i store but confidence
-            annot = [ann for ann in resp["mentions"] if "bestEntity"
-                     in ann and ann["bestEntity"]["kbIdentifier"] == ent][0]
-            start, end = int(annot["offset"]), int(annot["offset"] + annot["length"])
+            annot = ent2mention.get(ent)
+            if annot is None:
+                continue
+            start = int(annot["offset"]) + offset
+            end = start + int(annot["length"])
             surface = annot["name"]
             # confidence is in res["entityMetadata"] indexed by entity name
             confidence = float(resp[u"entityMetadata"][ent]["importance"])
@@ -312,7 +317,7 @@ class AnnotationParser(object):
         return anresp
 
     @staticmethod
-    def parse_raida(fn, cl, resp, cpsob, redo_ents):
+    def parse_raida(fn, cl, resp, cpsob, redo_ents, offset=0, text=None):
         """
         See L{parse}
         @type resp: json
@@ -333,8 +338,8 @@ class AnnotationParser(object):
                     continue
             else:
                 continue
-            start = int(ent["offset"])
-            end = int(ent["offset"]) + int(ent["length"])
+            start = int(ent["offset"]) + offset
+            end = start + int(ent["length"])
             surface = ent["name"]
             mtnkey = CorpusMgr.create_mention_key(fn, start, end)
 
@@ -351,14 +356,14 @@ class AnnotationParser(object):
         return anresp
 
     @staticmethod
-    def parse_babelfy(fn, cl, resp, cpsob, text, redo_ents):
+    def parse_babelfy(fn, cl, resp, cpsob, redo_ents, offset=0, text=None):
         """
         See L{parse}
         @note: only accepts annotations that have a DBpedia page
         """
         if not resp:
             return {}
-        data = json.loads(resp)
+        data = jsoncodec.loads(resp)
         anresp = {}
         for res in data:
             if (cfg.use_confidence and float(res["score"]) <
@@ -371,6 +376,7 @@ class AnnotationParser(object):
             end = res["charFragment"]["end"] + 1
             link = dbp_url.replace(cfg.DBPRESPREF, "")
             mention = text[start:end]
+            start, end = start + offset, end + offset
             confidence = res["score"]
             mtnkey = CorpusMgr.create_mention_key(fn, start, end)
 
@@ -416,6 +422,16 @@ class AnnotationParser(object):
         return chosen
 
 
+services.register(cfg.TNames.TM, parser=AnnotationParser.parse_tagme)
+services.register(cfg.TNames.SP, parser=AnnotationParser.parse_spotlight)
+services.register(cfg.TNames.PS, parser=AnnotationParser.parse_spotstat)
+services.register(cfg.TNames.WD, parser=AnnotationParser.parse_wminer)
+services.register(cfg.TNames.WI, parser=AnnotationParser.parse_wminer_remote)
+services.register(cfg.TNames.AI, parser=AnnotationParser.parse_aida)
+services.register(cfg.TNames.RA, parser=AnnotationParser.parse_raida)
+services.register(cfg.TNames.BF, parser=AnnotationParser.parse_babelfy)
+
+
 class CooccurrenceMgr():
     """Takes care of calculating co-occurrence between entities"""
 
@@ -479,32 +495,111 @@ class CooccurrenceMgr():
         return filt
 
     @staticmethod
-    def create_entity_edges_from_annotation_dict(di):
+    def _iter_sentence_entities(di, get_snbr, get_link):
         """
-        Create lists of edges per sentence from a dict of annotation-dict
-        dict format is {fn: {(start, end): {"key1": val1 ...}, }}
+        Entity labels for each sentence with annotations, in a single pass
+        over each document's annotations (see L{iter_entities_by_sentence})
+        @param get_snbr: function returning an annotation's sentence number
+        @param get_link: function returning an annotation's entity label
         """
-        print "- Start coocs"
-        edges = {}
-        # mk lists of entities by sentence
-        ebysent = {}
         dones = 0
-        for fn, annots in di.items():
+        for fn in sorted(di):
+            annots = di[fn]
             # empty annots
             if not annots:
                 continue
+            ebysent = {}
             try:
-                total_sents = max([en["snbr"] for posi, en in annots.items()])
+                for posi in sorted(annots):
+                    snbr = get_snbr(annots[posi])
+                    # annotations without sentence number have snbr None
+                    if snbr is not None:
+                        ebysent.setdefault(snbr, []).append(
+                            get_link(annots[posi]))
             except KeyError, msg:
                 print "KeyError, {}".format(msg)
                 continue
-            for sn in range(1, total_sents + 1):
-                ebysent[tuple([en["link"] for posi, en
-                        in annots.items() if en["snbr"] == sn])] = 1
+            except AttributeError, msg:
+                print "AttributeError, {}".format(msg)
+                continue
+            if not ebysent:
+                print "No sentence numbers, {}".format(fn)
+                continue
+            for snbr in sorted(ebysent):
+                yield tuple(ebysent[snbr])
             dones += 1
             if dones % cfg.node_progress == 0:
                 print "Done nodes for {} files: {}".format(
                     dones, time.asctime(time.localtime()))
+
+    @staticmethod
+    def iter_entities_by_sentence(di):
+        """
+        Yield a tuple of entity labels for each sentence with annotations,
+        in text order, from a dict of L{model.Annotation}. Sentences with
+        the same entities are all yielded, so that their co-occurrences are
+        all counted by L{count_edges}, which can take this generator.
+        dict format is {fn: {(start, end): L{model.Annotation}, ... }}
+        """
+        return CooccurrenceMgr._iter_sentence_entities(
+            di, lambda an: an.snbr, lambda an: an.enti.link)
+
+    @staticmethod
+    def iter_store_entities_by_sentence(store, rows=None):
+        """
+        Yield a tuple of entity labels for each sentence with annotations,
+        like L{iter_entities_by_sentence}, from a L{model.AnnotationStore}
+        (e.g. L{model.Corpus.store} after reading annotations with
+        L{clients.AnnotationReader}). Rows are sorted by doc, sentence
+        number and position at once, with numpy if installed, instead of
+        per document. The store must not grow while this runs
+        @param rows: row indexes to use (default all, see
+        L{model.AnnotationStore.select}). Rows without sentence number are
+        left out
+        """
+        cols = store.columns
+        docids = store.tables["doc"]
+        # docs ranked by id, as iter_entities_by_sentence sorts file names
+        docrank = [0] * len(docids)
+        for rank, doc in enumerate(sorted(xrange(len(docids)),
+                                          key=docids.__getitem__)):
+            docrank[doc] = rank
+        np = utils.get_numpy()
+        if np is not None:
+            rows = np.arange(len(store)) if rows is None else \
+                np.asarray(rows, dtype=int)
+            snbrs = store.as_numpy("snbr")[rows]
+            rows = rows[snbrs >= 0]
+            order = np.lexsort((store.as_numpy("end")[rows],
+                                store.as_numpy("start")[rows],
+                                store.as_numpy("snbr")[rows],
+                                np.asarray(docrank, dtype=int)[
+                                    store.as_numpy("doc")[rows]]))
+            rows = rows[order].tolist()
+        else:
+            if rows is None:
+                rows = xrange(len(store))
+            rows = sorted([row for row in rows if cols["snbr"][row] >= 0],
+                          key=lambda row: (docrank[cols["doc"][row]],
+                                           cols["snbr"][row],
+                                           cols["start"][row],
+                                           cols["end"][row]))
+        labels = store.tables["entity"]
+        for ke, sentrows in itertools.groupby(
+                rows, key=lambda row: (cols["doc"][row], cols["snbr"][row])):
+            yield tuple(labels[cols["entity"][row]] for row in sentrows)
+
+    @staticmethod
+    def create_entity_edges_from_annotation_dict(di):
+        """
+        Create lists of edges per sentence from a dict of annotation-dict
+        dict format is {fn: {(start, end): {"key1": val1 ...}, }}
+        @return: list with a tuple of entity labels per sentence
+        (see L{iter_entities_by_sentence})
+        """
+        print "- Start coocs"
+        ebysent = list(CooccurrenceMgr._iter_sentence_entities(
+            di, lambda en: en["snbr"], lambda en: en["link"]))
         print "Total sentences: {}".format(len(ebysent))
         print "Total nodes: {}".format(sum([len(k) for k in ebysent]))
         return ebysent
@@ -514,67 +609,56 @@ class CooccurrenceMgr():
         """
         Create lists of edges per sentence from a dict of L{model.Annotation}
         dict format is {fn: {(start, end): L{model.Annotation}, ... }}
+        @return: list with a tuple of entity labels per sentence
+        (see L{iter_entities_by_sentence})
         """
         print "- Start coocs"
-        edges = {}
-        # mk lists of entities by sentence
-        ebysent = {}
-        dones = 0
-        for fn, annots in di.items():
-            # empty annots
-            if not annots:
-                continue
-            try:
-                total_sents = max([an.snbr for posi, an in annots.items()])
-            except KeyError, msg:
-                print "KeyError, {}".format(msg)
-                continue
-            except AttributeError, msg:
-                print "AttributeError, {}".format(msg)
-                continue
-            for sn in range(1, total_sents + 1):
-                ebysent[tuple([an.enti.link for posi, an
-                        in annots.items() if an.snbr == sn])] = 1
-            dones += 1
-            if dones % cfg.node_progress == 0:
-                print "Done nodes for {} files: {}".format(
-                    dones, time.asctime(time.localtime()))
+        ebysent = list(CooccurrenceMgr.iter_entities_by_sentence(di))
         print "Total sentences: {}".format(len(ebysent))
         print "Total nodes: {}".format(sum([len(k) for k in ebysent]))
         return ebysent
 
-
     @staticmethod
-    def count_edges(ebysent, directed=False):
+    def create_cooccurrence_matrix(ebysent, directed=False):
         """
-        Count edges in corpus based on lists of edges by sentences
-        @param ebysent: hash with lists of edges per sentence as keys
-        and a dummy value.
+        Count edges in corpus into a L{CooccurrenceMatrix}, from which
+        top or thresholded edge lists can be taken
+        @param ebysent: iterable with a tuple of entity labels per sentence,
+        e.g. L{iter_entities_by_sentence}, to count without keeping the
+        tuples
+        @param directed: if False, (a, b) and (b, a) are counted as one edge
         """
-        edges = {}
+        matrix = CooccurrenceMatrix(directed=directed)
         done_sents = 0
         for lst in ebysent:
-            if not directed:
-                pairs = [tuple(sorted((i[0], i[1])))
-                         for i in itertools.combinations(lst, 2)
-                         if i[0] != i[1]]
-            else:
-                pairs = [i for i in itertools.combinations(lst, 2)
-                         if i[0] != i[1]]
-            for pair in pairs:
-                edges.setdefault(pair, 0)
-                edges[pair] += 1
+            matrix.add_sentence(lst)
             done_sents += 1
             if done_sents % cfg.sent_progress == 0:
                 print "Done sentences: {}".format(done_sents)
-        return edges
+        return matrix
+
+    @staticmethod
+    def count_edges(ebysent, directed=False):
+        """
+        Count edges in corpus based on lists of edges by sentences
+        (see L{create_cooccurrence_matrix})
+        @return: hash of counts by pair of labels. Unless directed, the
+        labels in a pair are sorted
+        """
+        return CooccurrenceMgr.create_cooccurrence_matrix(
+            ebysent, directed=directed).edges()
 
     @staticmethod
     def write_edge_dict_as_tsv(ed, outfn=None, printout=cfg.cooc_print,
                                svc="", cps=cfg.cpsname,
-                               runid=string.zfill(str(myutils.read_runid()), 3),
-                               use_header=cfg.use_cooc_header):
-        """Write out the edges as tsv, sorted by decreasing weight"""
+                               runid=None, use_header=cfg.use_cooc_header):
+        """
+        Write out the edges as tsv, sorted by decreasing weight
+        @param runid: run-id for the output filename, read from the run-id
+        file if None
+        """
+        if runid is None:
+            runid = string.zfill(str(myutils.read_runid()), 3)
         if use_header:
             outl = [cfg.cooc_header]
         else:
@@ -604,8 +688,196 @@ class CooccurrenceMgr():
                             time.asctime(time.localtime()))
 
 
+class CooccurrenceMatrix(object):
+    """
+    Entity co-occurrence counts as a sparse matrix. Entities are mapped to
+    integer ids, and counts are kept for the (row, column) id pairs seen,
+    in arrays sorted by pair (a COO matrix in canonical form).
+    Sentences are buffered, and the pairs for a batch of them are made and
+    summed at once with numpy, for all sentences with the same number of
+    entities together. numpy is optional: without it, counts are kept in
+    a hash by pair of labels, as in L{CooccurrenceMgr.count_edges} before.
+    @ivar directed: if False, (a, b) and (b, a) are counted as one edge
+    @ivar ids: entity id by label (with numpy)
+    @ivar labels: labels by entity id (with numpy)
+    """
+
+    # sentences buffered before their pairs are counted
+    BATCH = 200000
+
+    def __init__(self, directed=False):
+        self.directed = directed
+        self.ids = {}
+        self.labels = []
+        self._np = utils.get_numpy()
+        # buffered sentences: entity ids, and number of entities by sentence
+        self._sentids = array.array("l")
+        self._sentlens = array.array("l")
+        # counted pairs as (row << 32 | column) keys, and their counts
+        self._keys = None
+        self._counts = None
+        # counts by pair of labels without numpy
+        self._pairs = {}
+
+    def _id(self, label):
+        try:
+            return self.ids[label]
+        except KeyError:
+            self.ids[label] = len(self.labels)
+            self.labels.append(label)
+            return self.ids[label]
+
+    def add_sentence(self, labels):
+        """
+        Count the pairs of different entities in a sentence
+        @param labels: entity labels in the sentence, in text order
+        (directed edges go from the earlier to the later entity)
+        """
+        if len(labels) < 2:
+            return
+        if self._np is None:
+            pairs, directed = self._pairs, self.directed
+            for pair in itertools.combinations(labels, 2):
+                if pair[0] == pair[1]:
+                    continue
+                if not directed and pair[1] < pair[0]:
+                    pair = (pair[1], pair[0])
+                pairs[pair] = pairs.get(pair, 0) + 1
+            return
+        self._sentids.extend([self._id(label) for label in labels])
+        self._sentlens.append(len(labels))
+        if len(self._sentlens) >= self.BATCH:
+            self._flush()
+
+    def _flush(self):
+        """Count the pairs in the buffered sentences"""
+        if not self._sentlens:
+            return
+        np = self._np
+        ids = np.frombuffer(self._sentids,
+                            dtype=self._sentids.typecode).astype(np.int64)
+        lens = np.frombuffer(self._sentlens,
+                             dtype=self._sentlens.typecode).astype(np.int64)
+        self._sentids = array.array("l")
+        self._sentlens = array.array("l")
+        starts = np.cumsum(lens) - lens
+        keys = []
+        for length in np.unique(lens):
+            # one row per sentence with length entities
+            block = ids[starts[lens == length][:, None] + np.arange(length)]
+            first, second = np.triu_indices(length, 1)
+            rows = block[:, first].ravel()
+            cols = block[:, second].ravel()
+            keep = rows != cols
+            rows, cols = rows[keep], cols[keep]
+            if not self.directed:
+                rows, cols = np.minimum(rows, cols), np.maximum(rows, cols)
+            keys.append((rows << 32) | cols)
+        keys, counts = np.unique(np.concatenate(keys), return_counts=True)
+        if self._keys is not None:
+            keys, inverse = np.unique(np.concatenate((self._keys, keys)),
+                                      return_inverse=True)
+            counts = np.bincount(
+                inverse, weights=np.concatenate((self._counts, counts)))
+        self._keys = keys
+        self._counts = counts.astype(np.int64)
+
+    def _coo(self):
+        """Rows, columns and counts for the counted pairs (with numpy)"""
+        np = self._np
+        self._flush()
+        if self._keys is None:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+        return self._keys >> 32, self._keys & 0xffffffff, self._counts
+
+    def __len__(self):
+        if self._np is None:
+            return len(self._pairs)
+        return len(self._coo()[2])
+
+    def _labeled(self, order):
+        """
+        List of (pair of labels, count) for the counted pairs at indexes
+        order (with numpy). Unless directed, the labels in a pair are sorted
+        """
+        np = self._np
+        rows, cols, counts = self._coo()
+        rows, cols, counts = rows[order], cols[order], counts[order]
+        if not self.directed and len(rows):
+            # rank of each label in sorted order, to sort pairs at once
+            rank = np.empty(len(self.labels), dtype=np.int64)
+            rank[sorted(xrange(len(self.labels)),
+                        key=self.labels.__getitem__)] = \
+                np.arange(len(self.labels))
+            swap = rank[rows] > rank[cols]
+            rows, cols = np.where(swap, cols, rows), np.where(swap, rows, cols)
+        labels = self.labels
+        return zip(zip([labels[idx] for idx in rows.tolist()],
+                       [labels[idx] for idx in cols.tolist()]),
+                   counts.tolist())
+
+    def edges(self, min_count=1):
+        """
+        Hash of counts by pair of labels, for the pairs seen at least
+        min_count times. Unless directed, the labels in a pair are sorted
+        """
+        if self._np is None:
+            return dict((pair, cnt) for pair, cnt in self._pairs.iteritems()
+                        if cnt >= min_count)
+        return dict(self._labeled(
+            self._np.flatnonzero(self._coo()[2] >= min_count)))
+
+    def top_edges(self, k):
+        """
+        The k most frequent edges, as list of (pair of labels, count) by
+        decreasing count (edges tied with the last one may be left out)
+        """
+        if k <= 0:
+            return []
+        if self._np is None:
+            return heapq.nlargest(k, self._pairs.iteritems(),
+                                  key=operator.itemgetter(1))
+        np = self._np
+        counts = self._coo()[2]
+        if k < len(counts):
+            best = np.argpartition(-counts, k - 1)[:k]
+        else:
+            best = np.arange(len(counts))
+        return self._labeled(best[np.argsort(-counts[best], kind="mergesort")])
+
+    def threshold_edges(self, min_count):
+        """
+        Edges seen at least min_count times, as list of (pair of labels,
+        count) by decreasing count
+        """
+        if self._np is None:
+            return sorted([(pair, cnt) for pair, cnt
+                           in self._pairs.iteritems() if cnt >= min_count],
+                          key=operator.itemgetter(1), reverse=True)
+        np = self._np
+        counts = self._coo()[2]
+        kept = np.flatnonzero(counts >= min_count)
+        return self._labeled(kept[np.argsort(-counts[kept], kind="mergesort")])
+
+    def to_scipy(self):
+        """
+        Counts as a scipy.sparse CSR matrix, with entity ids (L{ids}) as
+        row and column indexes
+        @raise ImportError: if scipy or numpy are not installed
+        """
+        if self._np is None:
+            raise ImportError("numpy is needed")
+        from scipy import sparse
+        rows, cols, counts = self._coo()
+        return sparse.coo_matrix(
+            (counts, (rows, cols)),
+            shape=(len(self.labels), len(self.labels))).tocsr()
+
+
 # TEST
 if __name__ == "__main__":
+    import clients
     ar = clients.AnnotationReader(cfg)
     cc = CooccurrenceMgr()
     print "Tests with individual files"
@@ -638,7 +910,6 @@ if __name__ == "__main__":
                 #mycorpus, "", oneoutforall=False, has_snbr=True, has_normcat=False)  # options i had for Bentham corpus (or for uibo wireframe)
                 mycorpus, "", oneoutforall=True, has_snbr=True, has_normcat=True)     # used these options for ENB (as in uibo app DB format)
             print "Done reading"
-            edges_per_sentence = cc.create_entity_edges_from_annotation_objs(
-                annots)
-            counted_edges = cc.count_edges(edges_per_sentence)
+            counted_edges = cc.count_edges(
+                cc.iter_store_entities_by_sentence(mycorpus.store))
             cc.write_edge_dict_as_tsv(counted_edges, svc=svc, runid="TEST4")
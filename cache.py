@@ -0,0 +1,365 @@
+"""On-disk caches to avoid redoing work across runs"""
+
+from collections import OrderedDict
+import cPickle
+import hashlib
+import json
+import os
+import threading
+
+import jsoncodec
+
+
+class CacheMissException(Exception): pass
+
+
+class CachedResponse(object):
+    """
+    Stands for a L{requests.models.Response} read from L{ResponseCache},
+    with the attributes the L{clients} and L{analysis} use.
+    """
+
+    def __init__(self, content, url=None):
+        self.content = content
+        self.url = url
+        self.status_code = 200
+        self.ok = True
+        self.headers = {}
+
+    @property
+    def text(self):
+        return self.content.decode("utf8")
+
+    def json(self):
+        return jsoncodec.loads(self.content)
+
+    def __nonzero__(self):
+        return True
+
+
+class ResponseCache(object):
+    """
+    Content-addressed store for service responses, one file per response.
+    Keys are computed with L{make_key}. When the files take more than
+    max_bytes, the least recently used ones are removed.
+    @ivar cachedir: directory for the cache files
+    @ivar max_bytes: size bound for the cache (None for no bound)
+    @ivar replay: if True, the cache is read-only, and L{get} raises
+    L{CacheMissException} for responses not in it (so that no service is
+    called). Clients let it through like a network error, so the runners
+    list the item as failed (see L{runners.DefRunner.run_retry_queue})
+    """
+
+    SUFFIX = ".rsp"
+
+    def __init__(self, cachedir, max_bytes=None, replay=False):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self._lock = threading.Lock()
+        # size by key, from least to most recently used, filled on
+        # first access
+        self._index = None
+        self._total = 0
+
+    @staticmethod
+    def make_key(service, url, params, text):
+        """
+        Key for a response
+        @param service: service name (L{config.TNames})
+        @param url: service url
+        @param params: request options other than the text (without
+        api keys, which don't change the response)
+        @param text: text sent to the service, hashed as is: responses give
+        character offsets in it, so texts that differ in any way (even
+        unicode normalization or whitespace) get different keys
+        """
+        if isinstance(text, unicode):
+            text = text.encode("utf8")
+        # stdlib json, so that keys don't depend on the json backend
+        reqhash = hashlib.sha1(json.dumps(
+            [service, url, sorted(params.items())], sort_keys=True))
+        texthash = hashlib.sha1(text)
+        return "_".join((service, reqhash.hexdigest()[:12],
+                         texthash.hexdigest()))
+
+    def _path(self, key):
+        return os.path.join(self.cachedir, key + self.SUFFIX)
+
+    def _load_index(self):
+        """
+        List the cache files, by last use (file mtime).
+        Caller holds the lock
+        """
+        self._index = OrderedDict()
+        self._total = 0
+        if not os.path.isdir(self.cachedir):
+            return
+        files = []
+        for fn in os.listdir(self.cachedir):
+            if not fn.endswith(self.SUFFIX):
+                continue
+            st = os.stat(os.path.join(self.cachedir, fn))
+            files.append((st.st_mtime, fn[:-len(self.SUFFIX)], st.st_size))
+        for mtime, key, size in sorted(files):
+            self._index[key] = size
+            self._total += size
+
+    def get(self, key):
+        """
+        Return the response content for key, or None if not cached
+        @raise CacheMissException: if not cached in replay mode
+        """
+        with self._lock:
+            if self._index is None:
+                self._load_index()
+            if key not in self._index:
+                if self.replay:
+                    raise CacheMissException(key)
+                return None
+            with open(self._path(key), "rb") as inf:
+                content = inf.read()
+            if not self.replay:
+                # mtime records last use, for eviction in later runs
+                os.utime(self._path(key), None)
+                self._index[key] = self._index.pop(key)
+            return content
+
+    def put(self, key, content):
+        """Store response content for key"""
+        if self.replay:
+            return
+        with self._lock:
+            if self._index is None:
+                self._load_index()
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir)
+            # write to a temp file and rename, to never leave partial files
+            tmpfn = "{}.{}.tmp".format(self._path(key),
+                                       threading.current_thread().ident)
+            with open(tmpfn, "wb") as outf:
+                outf.write(content)
+            os.rename(tmpfn, self._path(key))
+            if key in self._index:
+                self._total -= self._index.pop(key)
+            self._index[key] = len(content)
+            self._total += len(content)
+            self._evict()
+
+    def _evict(self):
+        """Remove least recently used files until under max_bytes"""
+        if self.max_bytes is None:
+            return
+        while self._total > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            self._total -= size
+
+
+_response_caches = {}
+_response_caches_lock = threading.Lock()
+
+
+def get_response_cache(cfg):
+    """
+    Response cache for the config, shared by all the clients in the process.
+    Returns None if the cache is not active in config.
+    @rtype: L{ResponseCache}
+    """
+    if not cfg.cache["active"]:
+        return None
+    with _response_caches_lock:
+        if cfg.cache["dir"] not in _response_caches:
+            _response_caches[cfg.cache["dir"]] = ResponseCache(
+                cfg.cache["dir"], max_bytes=cfg.cache["max_bytes"],
+                replay=cfg.cache["replay"])
+        return _response_caches[cfg.cache["dir"]]
+
+
+class SentenceCache(object):
+    """
+    Sentence positions for texts, by a hash of the text (see L{make_key}).
+    Read from file on first use, and new entries are appended to it,
+    one text per line.
+    @ivar path: file for the cache
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._spans = None
+
+    @staticmethod
+    def make_key(text):
+        if isinstance(text, unicode):
+            text = text.encode("utf8")
+        return hashlib.sha1(text).hexdigest()
+
+    def _load(self):
+        """Read the cache file. Caller holds the lock"""
+        self._spans = {}
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as inf:
+            for line in inf:
+                # an interrupted run can leave the last line incomplete
+                if not line.endswith("\n"):
+                    break
+                try:
+                    key, spans = line.rstrip("\n").split("\t")
+                    self._spans[key] = [
+                        tuple(int(po) for po in span.split(":"))
+                        for span in spans.split()]
+                except ValueError:
+                    continue
+
+    def get(self, key):
+        """Return list of (start, end) for sentences, None if not cached"""
+        with self._lock:
+            if self._spans is None:
+                self._load()
+            return self._spans.get(key)
+
+    def put(self, key, spans):
+        """Store list of (start, end) for sentences"""
+        with self._lock:
+            if self._spans is None:
+                self._load()
+            if key in self._spans:
+                return
+            self._spans[key] = list(spans)
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(self.path, "a") as outf:
+                outf.write("{}\t{}\n".format(key, " ".join(
+                    "{}:{}".format(start, end) for start, end in spans)))
+
+
+_sentence_caches = {}
+_sentence_caches_lock = threading.Lock()
+
+
+def get_sentence_cache(cfg):
+    """
+    Sentence cache for the config, shared in the process.
+    Returns None if the cache is not active in config.
+    @rtype: L{SentenceCache}
+    """
+    sentcfg = cfg.sentence_cache
+    if not sentcfg["active"]:
+        return None
+    with _sentence_caches_lock:
+        if sentcfg["path"] not in _sentence_caches:
+            _sentence_caches[sentcfg["path"]] = SentenceCache(sentcfg["path"])
+        return _sentence_caches[sentcfg["path"]]
+
+
+class CategoryCache(object):
+    """
+    Categories and normalized category by entity label, kept across runs
+    and corpora so that they are not worked out again for entities seen
+    before (see L{model.Corpus.add_entity_to_corpus}).
+    The file is an append-only log of pickled (label, categories, normcat,
+    services) records, read on first use; later records win. When it holds
+    more than max_entries entities, the least recently stored are dropped,
+    and the file is rewritten when most of its records are stale.
+    @ivar path: file for the cache
+    @ivar max_entries: max entities kept (None for no bound)
+    """
+
+    def __init__(self, path, max_entries=None):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = None
+        # records in the file, including the overwritten ones
+        self._records = 0
+
+    def _load(self):
+        """Read the cache file. Caller holds the lock"""
+        self._entries = OrderedDict()
+        self._records = 0
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as inf:
+            while True:
+                try:
+                    link, categs, normcat, svcs = cPickle.load(inf)
+                except EOFError:
+                    break
+                except (cPickle.UnpicklingError, ValueError, TypeError):
+                    # an interrupted run can leave the last record incomplete
+                    break
+                self._entries.pop(link, None)
+                self._entries[link] = (categs, normcat, svcs)
+                self._records += 1
+        self._evict()
+
+    def get(self, link):
+        """
+        Return (categories, normcat, services whose categories are included)
+        for entity link, None if not cached
+        """
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            return self._entries.get(link)
+
+    def put(self, link, categs, normcat, svcs):
+        """Store categories and normalized category for entity link"""
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            entry = (dict(categs), normcat, list(svcs))
+            if self._entries.get(link) == entry:
+                return
+            self._entries.pop(link, None)
+            self._entries[link] = entry
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(self.path, "ab") as outf:
+                cPickle.dump((link,) + entry, outf, 2)
+            self._records += 1
+            self._evict()
+            if self._records > 2 * max(len(self._entries), 1000):
+                self._compact()
+
+    def _evict(self):
+        """Drop least recently stored entries beyond max_entries"""
+        if self.max_entries is None:
+            return
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _compact(self):
+        """Rewrite the file with the entries kept only"""
+        tmpfn = "{}.tmp".format(self.path)
+        with open(tmpfn, "wb") as outf:
+            for link, entry in self._entries.items():
+                cPickle.dump((link,) + entry, outf, 2)
+        os.rename(tmpfn, self.path)
+        self._records = len(self._entries)
+
+
+_category_caches = {}
+_category_caches_lock = threading.Lock()
+
+
+def get_category_cache(cfg):
+    """
+    Category cache for the config, shared in the process.
+    Returns None if not active in config.
+    @rtype: L{CategoryCache}
+    """
+    if not cfg.use_categ_cache:
+        return None
+    with _category_caches_lock:
+        if cfg.categ_cache not in _category_caches:
+            _category_caches[cfg.categ_cache] = CategoryCache(
+                cfg.categ_cache, max_entries=cfg.categ_cache_size)
+        return _category_caches[cfg.categ_cache]
@@ -5,12 +5,21 @@ import json
 import os
 import logging
 import re
-import requests
-import spotlight
+import threading
 import time
 
 import model as md
 import analysis
+import cache
+from config import TNames
+import jsoncodec
+import services
+import throttle
+import utils
+
+# loaded on first use, not needed to read annotations
+requests = utils.LazyModule("requests")
+spotlight = utils.LazyModule("spotlight")
 
 
 logging.getLogger("requests").setLevel(logging.WARNING)
@@ -19,13 +28,164 @@ logging.getLogger("requests").setLevel(logging.WARNING)
 class EmptyTextException(Exception): pass
 
 
+def network_errors():
+    """
+    Errors raised by clients when a request failed after all retries
+    (see L{WSClient._send}), or could not be sent
+    """
+    return (requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            cache.CacheMissException,
+            throttle.QuotaExceededException,
+            throttle.CircuitOpenException,
+            throttle.ServiceUnavailableException)
+
+
 class WSClient(object):
     """
     Calls Entity Linking Web Services and returns responses
     @ivar cfg: config module
+    @ivar session: pooled keep-alive session the requests go through,
+    created on the first request (see L{_request})
     """
+
+    # payload fields with the text, and with api keys
+    TEXT_OPTIONS = ("text", "source")
+    KEY_OPTIONS = ("key", "gcube-token")
+
     def __init__(self, cfg):
         self.cfg = cfg
+        self.session = None
+        self._session_lock = threading.Lock()
+
+    def _http_option(self, option):
+        """
+        Value for an http option (see C{http} in L{config}), which can be
+        overridden in the service params.
+        """
+        return self.cfg.params[self.name].get(option, self.cfg.http[option])
+
+    def _create_session(self):
+        """
+        Create a session that keeps connections to the service alive,
+        so that each request does not need a new TCP connection and TLS
+        handshake.
+        @rtype: requests.Session
+        """
+        session = requests.Session()
+        # pool must fit all requests a runner keeps in flight
+        pool_size = max(self._http_option("pool_size"),
+                        self.cfg.params[self.name].get("workers", 1))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        # requests decompresses gzip responses transparently
+        if self._http_option("gzip"):
+            session.headers["Accept-Encoding"] = "gzip, deflate"
+        else:
+            session.headers["Accept-Encoding"] = "identity"
+        return session
+
+    def _send(self, send):
+        """
+        Do a request respecting the service's rate limit, retrying it with
+        backoff after transient errors, unless the service's circuit breaker
+        is open (see L{throttle})
+        @param send: callable doing the request once, returning a
+        L{requests.models.Response} or the decoded response
+        @raise throttle.QuotaExceededException: if the service's daily quota
+        in config is used up
+        @raise throttle.CircuitOpenException: if the service failed too often
+        lately
+        @raise throttle.ServiceUnavailableException: if the service answered
+        with a transient error status to every attempt
+        @raise requests.exceptions.ConnectionError, requests.exceptions.Timeout:
+        if the last attempt raised them
+        """
+        limiter = throttle.get_rate_limiter(self.cfg, self.name)
+        policy = throttle.get_retry_policy(self.cfg, self.name)
+        breaker = throttle.get_circuit_breaker(self.cfg, self.name)
+        failures = 0
+        while True:
+            breaker.check()
+            if limiter is not None:
+                limiter.acquire()
+            started = time.time()
+            try:
+                resp = send()
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout), msg:
+                error, status = msg, None
+            else:
+                error, status = None, getattr(resp, "status_code", 200)
+            if limiter is not None and status is not None:
+                try:
+                    retry_after = float(resp.headers["Retry-After"])
+                except (AttributeError, KeyError, ValueError):
+                    retry_after = None
+                limiter.record(status, latency=time.time() - started,
+                               retry_after=retry_after)
+            if error is None and status not in policy.TRANSIENT:
+                breaker.success()
+                return resp
+            breaker.failure()
+            failures += 1
+            if failures >= policy.attempts:
+                if error is not None:
+                    raise error
+                raise throttle.ServiceUnavailableException(
+                    "HTTP {}".format(status))
+            print "! [{}] {}, retry {}".format(
+                self.name, error.__class__.__name__ if error else status,
+                failures)
+            time.sleep(policy.delay(failures))
+
+    def _cache_key(self, url, payload):
+        """
+        Key for a request in the response cache (see L{cache.ResponseCache})
+        @param url: url for the request
+        @param payload: request data or params (dict or json string)
+        """
+        if isinstance(payload, basestring):
+            payload = json.loads(payload)
+        params = dict((k, v) for k, v in payload.items()
+                      if k not in self.TEXT_OPTIONS + self.KEY_OPTIONS)
+        for option in self.TEXT_OPTIONS:
+            if option in payload:
+                text = payload[option]
+                break
+        else:
+            text = u""
+        return cache.ResponseCache.make_key(self.name, url, params, text)
+
+    def _request(self, method, url, **kwargs):
+        """
+        Send a request through the client's session, or get its response
+        from the response cache if active in config
+        @param method: http method ("get", "post")
+        @param url: url for the request
+        @param kwargs: options for L{requests.Session.request}
+        @rtype: requests.models.Response or L{cache.CachedResponse}
+        @raise cache.CacheMissException: if response not cached and the cache
+        is in replay mode
+        @raise network_errors(): if the request failed (see L{_send})
+        """
+        rcache = cache.get_response_cache(self.cfg)
+        if rcache is not None:
+            key = self._cache_key(url, kwargs.get("data", kwargs.get("params")))
+            content = rcache.get(key)
+            if content is not None:
+                return cache.CachedResponse(content, url=url)
+        if self.session is None:
+            with self._session_lock:
+                if self.session is None:
+                    self.session = self._create_session()
+        kwargs.setdefault("timeout", self._http_option("timeout"))
+        resp = self._send(lambda: self.session.request(method, url, **kwargs))
+        if rcache is not None and resp.status_code == 200:
+            rcache.put(key, resp.content)
+        return resp
 
     def create_payload(self, text=None, opts=None):
         """Creates the client request (abstract)"""
@@ -66,17 +226,17 @@ class TagmeClient(WSClient):
         """
         if payload["text"] == "":
             raise EmptyTextException({"message": "\n! Empty text"})
-        try:
-            req = requests.post(self.pars["url"], data=payload)
-        except requests.exceptions.ConnectionError:
-            print "! ConnectionError"
-            return {}
-        resp = req.json()
+        req = self._request("post", self.pars["url"], data=payload)
+        resp = jsoncodec.loads(req.content)
         return resp
 
 
 class SpotlightClient(WSClient):
-    """Calls DBpedia Spotlight (Lucene backend) using pyspotlight module"""
+    """
+    Calls DBpedia Spotlight (Lucene backend) using pyspotlight module
+    @note: pyspotlight does its own requests, so this client does not use
+    the pooled session in L{WSClient}
+    """
 
     def __init__(self, cfg):
         super(SpotlightClient, self).__init__(cfg)
@@ -85,10 +245,18 @@ class SpotlightClient(WSClient):
 
     def get_response(self, text):
         """@rtype: dict"""
+        rcache = cache.get_response_cache(self.cfg)
         try:
-            annotations = spotlight.annotate(
+            if rcache is not None:
+                key = cache.ResponseCache.make_key(
+                    self.name, self.pars["url"],
+                    {"confidence": self.pars["minconf"]}, text)
+                content = rcache.get(key)
+                if content is not None:
+                    return jsoncodec.loads(content)
+            annotations = self._send(lambda: spotlight.annotate(
                 self.pars["url"], text,
-                confidence=self.pars["minconf"])
+                confidence=self.pars["minconf"]))
         except spotlight.SpotlightException, msg:
             print "SpotlightException: {}".format(msg)
             return {}
@@ -96,9 +264,8 @@ class SpotlightClient(WSClient):
             print "HTTPError: {0}\nTEXT: \"{1}\"".format(
                 repr(msg2), repr(text))
             return {}
-        except requests.exceptions.ConnectionError:
-            print "! ConnectionError"
-            return {}
+        if rcache is not None:
+            rcache.put(key, jsoncodec.dumps(annotations))
         return annotations
 
 
@@ -121,11 +288,12 @@ class SpotstatClient(WSClient):
 
     def get_response(self, text):
         """@rtype: requests.models.Response"""
-        self.pars.update({"text": text})
+        # copy so that concurrent calls don't share the text
+        pars = dict(self.pars, text=text)
         try:
-            annotations = requests.get(self.pars["url"],
+            annotations = self._request("get", pars["url"],
                 headers=self.headers,
-                params=self.pars)
+                params=pars)
         except spotlight.SpotlightException, msg:
             print "SpotlightException: {}".format(msg)
             return {}
@@ -133,9 +301,6 @@ class SpotstatClient(WSClient):
             print "HTTPError: {0}\nTEXT: \"{1}\"".format(
                 repr(msg), repr(text))
             return {}
-        except requests.exceptions.ConnectionError:
-            print "! ConnectionError"
-            return {}
         return annotations
 
 
@@ -179,15 +344,12 @@ class WikipediaMinerClientDexter(WSClient):
             raise EmptyTextException({"message": "Empty text"})
             return
         try:
-            resp = requests.get(self.pars["url"], params=payload,
-                                headers=self.headers)
+            resp = self._request("get", self.pars["url"], params=payload,
+                                 headers=self.headers)
         except requests.HTTPError, msg2:
             print "HTTPError: {0}\nTEXT: \"{1}\"".format(
                 repr(msg2), repr(payload["text"]))
             return {}
-        except requests.exceptions.ConnectionError:
-            print "! ConnectionError"
-            return {}
         return resp
 
 
@@ -226,14 +388,11 @@ class WikipediaMinerClientRemote(WSClient):
             raise EmptyTextException({"message": "Empty text"})
             return
         try:
-            req = requests.post(self.pars["url"], data=payload)
+            req = self._request("post", self.pars["url"], data=payload)
         except requests.HTTPError, msg2:
             print "HTTPError: {0}\nTEXT: \"{1}\"".format(
                 repr(msg2), repr(payload["source"]))
             return {}
-        except requests.exceptions.ConnectionError:
-            print "! ConnectionError"
-            return {}
         resp = req.text
         return resp
 
@@ -265,17 +424,14 @@ class AidaClient(WSClient):
             raise EmptyTextException({"message": "Empty text"})
             return
         try:
-            req = requests.post(self.pars["url"], data=payload)
+            req = self._request("post", self.pars["url"], data=payload)
         except requests.HTTPError, msg2:
             print "HTTPError: {0}\nTEXT: \"{1}\"".format(
                 repr(msg2), repr(payload["text"]))
             return {}
-        except requests.exceptions.ConnectionError:
-            print "! ConnectionError"
-            return {}
         if self.VERBOSE:
             print req.url
-        resp = req.json()
+        resp = jsoncodec.loads(req.content)
         return resp
 
 
@@ -306,17 +462,14 @@ class AidaRemoteClient(WSClient):
             raise EmptyTextException({"message": "Empty text"})
             return
         try:
-            req = requests.post(self.pars["url"], data=payload)
+            req = self._request("post", self.pars["url"], data=payload)
         except requests.HTTPError, msg2:
             print "HTTPError: {0}\nTEXT: \"{1}\"".format(
                 repr(msg2), repr(payload["text"]))
             return {}
-        except requests.exceptions.ConnectionError:
-            print "! ConnectionError"
-            return {}
         if self.VERBOSE:
             print req.url
-        resp = req.json()
+        resp = jsoncodec.loads(req.content)
         return resp
 
 
@@ -336,12 +489,40 @@ class BabelfyClient(WSClient):
         return options
 
     def get_response(self, payload):
-        res = requests.post(self.pars["url"],
-                            headers={'Accept-encoding': 'gzip'},
-                            data=payload)
+        res = self._request("post", self.pars["url"], data=payload)
         return res.content
 
 
+def load_response_object(raw, decoded):
+    """
+    Response object for a stored raw response, for clients whose
+    responses are parsed from the http response (see L{services.Service})
+    """
+    return cache.CachedResponse(raw.encode("utf8"))
+
+
+def load_response_text(raw, decoded):
+    """
+    Text for a stored raw response, for clients whose responses are
+    parsed from the response text (see L{services.Service})
+    """
+    return raw
+
+
+services.register(TNames.TM, client=TagmeClient)
+services.register(TNames.SP, client=SpotlightClient)
+services.register(TNames.PS, client=SpotstatClient,
+                  raw_loader=load_response_object)
+services.register(TNames.WD, client=WikipediaMinerClientDexter,
+                  raw_loader=load_response_object)
+services.register(TNames.WI, client=WikipediaMinerClientRemote,
+                  raw_loader=load_response_text)
+services.register(TNames.AI, client=AidaClient)
+services.register(TNames.RA, client=AidaRemoteClient)
+services.register(TNames.BF, client=BabelfyClient,
+                  raw_loader=load_response_text)
+
+
 class AnnotationReader(object):
     """
     Reads annotations from files formatted as in L{writers}
@@ -443,6 +624,8 @@ class AnnotationReader(object):
                     line = inf.readline()
                     continue
                 line = inf.readline()
+        for ke in annots:
+            cpsob.add_annotations(ke, annots[ke])
         return annots
 
     def read_dir(self, dr, svc, cpsob, runid, oneoutforall=False, mask=None,
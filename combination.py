@@ -26,11 +26,19 @@ import utils
 
 
 lgr = logging.getLogger(__name__)
-utils.Utils.specify_log(lgr, cfg.rover_log, logging.INFO)
 
 myutils = utils.Utils(cfg)
 
 
+def init_rover_log():
+    """
+    Add the file handler for the ROVER log (done on first L{Combiner},
+    not on import)
+    """
+    if not lgr.handlers:
+        utils.Utils.specify_log(lgr, cfg.rover_log, logging.INFO)
+
+
 class Group(object):
     """
     Represents groups of overlapping annotations.
@@ -320,6 +328,7 @@ class Combiner(object):
     def __init__(self, cf):
         self.cfg = cfg
         self.ar = cl.AnnotationReader(self.cfg)
+        init_rover_log()
 
     def collect_annotations_for_service(self, infi, svc, collected=None):
         """
@@ -7,9 +7,19 @@ import os
 cpsname = "conll"  # name to identify corpus with in output files
 DBG = False
 limit = 100000000000#00000000  # max files to run (for tests)
-waitfor = 0  # sleep between connections
+waitfor = 0  # sleep between connections, for services without a "rate" in params
 myinput = "ABSOLUTE PATH TO INPUT"
 files2skip = "ABSOLUTE PATH TO LIST OF FILES WHOSE NAMES WILL BE IGNORED"
+prefetch = 8  # input files read ahead on a background thread (0 for none)
+# input format (L{readers.create_reader}): "files" (a file is a document),
+# or files with one document per line: "jsonl", "tsv" or "lines".
+# For those, the input can be a file or a directory of files, and files
+# ending in .gz are decompressed as read. "id" and "text" are the keys (jsonl,
+# "id" and "text" if not set) or columns (tsv, a number or a header name,
+# 0 and 1 if not set) for the document id and text. Documents without an id
+# (or with "id" set to None) are identified by file name and line number
+reader = {"format": "files",
+          "header": False}  # tsv files start with a header line
 oneoutforall = True  # write responses for whole corpus to the same output file (True)
                      # or write to individual files
 mywscheme = "conll"  # chosen weighting scheme for rover
@@ -64,42 +74,86 @@ linker_order = (TNames.TM, TNames.PS, TNames.SP, TNames.WI,
 #                 TNames.I2, TNames.I3, TNames.BF, TNames.WI)
 assert [lo in activate for lo in linker_order]
 
+# send each document to all active linkers at once (L{runners.MultiRunner})
+# instead of running the whole input with each linker in turn. Output is the
+# same: responses for the linkers after the first are kept in a temporary
+# file and parsed in linker order
+fan_out = False
+
 # module params ---------------------------------------------------------------
 # The minimum confidence here is 0, so that L{clients} get all possible responses.
 # Then L{analysis.AnnotationParser} uses values in L{MinConf} below to create
 # L{model.Annotation} objects
+# "workers" is the number of requests L{runners.DefRunner} keeps in flight
+# for the service (1 means one request at a time)
+# "rate" limits requests per second ("rps"), at once after idle time ("burst")
+# and per day ("daily"). See L{throttle.RateLimiter}
 params = {
     # TNames.TM: {"url": "http://tagme.di.unipi.it/tag",
     TNames.TM: {"url": "https://tagme.d4science.org/tagme/tag",
                 "minconf": 0.0,
                 "key": "ADD YOUR KEY",
                 "include_categories": True,
-                "lang": "en"},
+                "lang": "en",
+                "workers": 4,
+                "rate": {"rps": 10, "burst": 4}},
     TNames.SP: {"url": "http://spotlight.dbpedia.org/rest/annotate",
-                "minconf": 0.0},
+                "minconf": 0.0,
+                "workers": 4,
+                "rate": {"rps": 10, "burst": 4}},
     #TNames.PS: {"url": "http://spotlight.sztaki.hu:2222/rest/annotate",
     TNames.PS: {"url": "http://localhost:2222/rest/annotate",
-                "minconf": 0.0},
+                "minconf": 0.0,
+                "workers": 4},
     # disconnected
     TNames.WI: {"url": "http://wikipedia-miner.cms.waikato.ac.nz/services/wikify",
     #TNames.WI: {"url": "http://galan.ehu.es/wikiminer/wikify",
                 # to get categories
                 "catsvc": "http://wikipedia-miner.cms.waikato.ac.nz/services/exploreArticle",
-                "minconf": 0.0},
+                "minconf": 0.0,
+                "workers": 1},
     TNames.WD: {"url": "http://localhost:8080/dexter-webapp/api/rest/annotate",
-                "minconf": 0.0},
+                "minconf": 0.0,
+                "workers": 2},
     TNames.AI: {"url": "http://localhost:8080/aida/service/disambiguate-defaultsettings",
     # TNames.AI: {"url": "http://localhost:8080/aida/service/disambiguate",
     #            "minconf": 0.0, "tech": "LOCAL"}, # GRAPH is default
-                "minconf": 0.0},  # GRAPH is default
+                "minconf": 0.0,  # GRAPH is default
+                "workers": 2},
     TNames.RA: {"url": "https://gate.d5.mpi-inf.mpg.de/aida/service/disambiguate",
-                "minconf": 0.0},
+                "minconf": 0.0,
+                "workers": 2,
+                "rate": {"rps": 2, "burst": 2}},
     TNames.BF: {"url": "https://babelfy.io/v1/disambiguate",
                 "minconf": 0.0,
                 "key1": "ADD YOUR KEY",     # 1000 requests per day each
-                "lang": 'EN'}
+                "lang": 'EN',
+                "workers": 2,
+                "rate": {"rps": 2, "burst": 2, "daily": 1000}}
 }
 
+# http connections: each client keeps a pooled keep-alive session
+# (L{clients.WSClient}). Any of these can be overridden in a service's params
+http = {"pool_size": 10,      # connections kept per client
+        "timeout": (10, 300), # seconds to connect, seconds to read response
+        "gzip": True}         # ask for compressed responses
+
+# retries for failed requests (L{throttle.RetryPolicy}), and consecutive
+# failures after which a service gets no requests for a while
+# (L{throttle.CircuitBreaker}). Can be overridden in a service's params
+# with a "retries" dict
+retries = {"attempts": 4,           # attempts per request
+           "backoff": 1.0,          # seconds after 1st failure, then doubled
+           "max_backoff": 30.0,
+           "breaker_failures": 8,
+           "breaker_cooldown": 60.0}
+
+# long documents are split into chunks of whole sentences of up to
+# "max_chars" characters (0 for no chunking), whose requests are sent
+# concurrently (L{runners.DefRunner}). Annotations get document positions.
+# Can be overridden in a service's params with a "chunking" dict
+chunking = {"max_chars": 0}
+
 # paths
 basedir = os.path.join(os.path.dirname(os.path.abspath(
     inspect.getfile(inspect.currentframe()))))
@@ -114,12 +168,41 @@ runidf = os.path.join(os.path.join(basedir, os.pardir),
                       "elclient_other" + os.sep + "runid")
 runidnbr = 1
 
+# journal of the items written in a run (L{writers.Checkpoint}), in logdir,
+# so that an interrupted run can be resumed with --resume (which turns the
+# journal on too). Lines are synced to disk every "sync_every" items
+checkpoint = {"active": False,
+              "sync_every": 100}
+
+# response cache (L{cache.ResponseCache}): reuse service responses across runs.
+# With "replay", the cache is read-only and services are never called:
+# a response not in cache fails like a network error, so the item is
+# retried from cache at the end and then listed in the failed items file
+cache = {"active": False,
+         "dir": os.path.join(os.path.join(basedir, os.pardir),
+                             "elclient_other" + os.sep + "elclientcache"),
+         "max_bytes": 2 * 1024 ** 3,  # least recently used removed beyond this
+         "replay": False}
+
+# sentence positions by text (L{cache.SentenceCache}), so that a text is
+# sentence-split only once across runs
+sentence_cache = {"active": False,
+                  "path": os.path.join(cache["dir"], "sentences.tsv")}
+
+# json library to decode and encode responses (L{jsoncodec}): "ujson",
+# "simplejson" or "json". None for the fastest installed
+json_backend = None
+
 res_pickle = os.path.join(outdir, "{}.pgz".format(cpsname))
 
 
 # entity classification =======================================================
 add_categs = True
+# keep categories and normalized category of entities across runs in
+# categ_cache (L{cache.CategoryCache}), so they are not worked out again
+use_categ_cache = False
 categ_cache = os.path.join(datadir, "categ_cache.p")
+categ_cache_size = 1000000  # max entities kept
 perind = os.path.join(datadir, "percat.xml")
 orgind = os.path.join(datadir, "orgcat.xml")
 locind = os.path.join(datadir, "loccat.xml")
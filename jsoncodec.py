@@ -0,0 +1,80 @@
+"""
+JSON decoding and encoding for service responses, with the fastest backend
+installed: ujson, then simplejson, then the standard library json.
+A backend can be chosen with C{json_backend} in L{config}.
+All backends raise ValueError for invalid JSON, and decode strings as
+unicode.
+"""
+
+import importlib
+import json
+
+import config as cfg
+
+
+BACKENDS = ("ujson", "simplejson", "json")
+
+
+def _find_backend(name=None):
+    """
+    Module for the backend called name, or for the first one installed
+    in L{BACKENDS} if name is None
+    """
+    for candidate in ((name,) if name is not None else BACKENDS):
+        try:
+            module = importlib.import_module(candidate)
+        except ImportError:
+            if name is not None:
+                raise
+            continue
+        # without its C extension, simplejson is slower than json
+        if (name is None and candidate == "simplejson" and
+            module.scanner.c_make_scanner is None):
+            continue
+        return candidate, module
+    return "json", json
+
+
+def _ujson_loads(text):
+    # precise_float so that numbers are decoded as by the other backends
+    return _module.loads(text, precise_float=True)
+
+
+def _ujson_dumps(obj):
+    # 15 is the max precision ujson gives floats
+    return _module.dumps(obj, escape_forward_slashes=False,
+                         double_precision=15)
+
+
+def _simplejson_loads(text):
+    # simplejson decodes ascii-only strings in a str as str
+    if isinstance(text, str):
+        text = text.decode("utf8")
+    return _module.loads(text)
+
+
+def use_backend(name=None):
+    """
+    Decode and encode with the backend called name (see L{BACKENDS}),
+    or with the fastest installed if None
+    @raise ImportError: if the backend is not installed
+    """
+    global backend, _module, loads, dumps
+    backend, _module = _find_backend(name)
+    if backend == "ujson":
+        loads, dumps = _ujson_loads, _ujson_dumps
+    elif backend == "simplejson":
+        loads, dumps = _simplejson_loads, _module.dumps
+    else:
+        loads, dumps = _module.loads, _module.dumps
+
+
+# name of the backend in use
+backend = None
+_module = None
+# decode a json string
+loads = None
+# encode an object as a json string
+dumps = None
+
+use_backend(cfg.json_backend)
@@ -31,8 +31,15 @@ def main():
     mycps = md.Corpus(cfg, name=argus.corpus_name)  # corpus object
     rmgr = rn.RunnerManager(cfg)  # runner manager
     utl.setup(outdir=argus.myout, outresps=argus.myoutresps)
-    myrunid = utl.read_runid()
-    myreader = rd.DefReader(cfg)
+    if argus.resume is not None:
+        myrunid = int(argus.resume)
+    else:
+        myrunid = utl.read_runid()
+    if cfg.checkpoint["active"] or argus.resume is not None:
+        checkpoint = wr.Checkpoint(cfg, mycps.name, myrunid)
+    else:
+        checkpoint = None
+    myreader = rd.create_reader(cfg)
     mywriter = wr.Obj2TsvWriter(cfg)
 
     # linker specific ---------------------------------------------------------
@@ -43,6 +50,8 @@ def main():
         if cfg.use_all_linkers or cfg.activate[linker]["general"]:
             myrunner = rmgr.create_runner(linker, myreader, mywriter)
             if myrunner:
+                if checkpoint is not None:
+                    myrunner.use_checkpoint(checkpoint)
                 runners.append(myrunner)
             else:
                 print "! Error creating runner for [{}]".format(linker)
@@ -53,16 +62,28 @@ def main():
         ", ".join([ru.cl.name for ru in runners]))
 
     try:
-        for runner in runners:
-            for resp, anns, dob, fn in \
-                runner.run_all(argus.myinput, argus.myskiplist, mycps):
-                # can deduplicate mentions or import to sql from here
+        if cfg.fan_out:
+            multi = rn.MultiRunner(cfg, runners)
+            for runner, resp, anns, dob, fn in \
+                multi.run_all(argus.myinput, argus.myskiplist, mycps):
                 runner.write_results(resp, anns, fn, mycps, myrunid,
                                      outdir=argus.myout,
                                      outresps=argus.myoutresps)
+        else:
+            for runner in runners:
+                for resp, anns, dob, fn in \
+                    runner.run_all(argus.myinput, argus.myskiplist, mycps):
+                    # can deduplicate mentions or import to sql from here
+                    runner.write_results(resp, anns, fn, mycps, myrunid,
+                                         outdir=argus.myout,
+                                         outresps=argus.myoutresps)
     finally:
         # cleanup
-        utl.cleanup(myrunid)
+        if checkpoint is not None:
+            checkpoint.close()
+        # a resumed run keeps its id, and the next run id stays as it was
+        if argus.resume is None:
+            utl.cleanup(myrunid)
 
     print "~~ END: {} ~~".format(time.asctime(time.localtime()))
 
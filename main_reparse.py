@@ -0,0 +1,252 @@
+"""
+Re-parses the raw responses written by a run (see
+L{writers.DefWriter.write_raw_responses}) into annotations, without calling
+the services again, e.g. after changing confidence thresholds
+(L{config.MinConfs}) or the category logic. Files are parsed across
+a process pool, and annotations are written as by L{main}.
+Texts for the responses (the run's input) are optional, but needed for
+sentence numbers, and for services whose parser needs the text (Babelfy).
+"""
+
+import argparse
+import codecs
+import inspect
+import itertools
+import multiprocessing
+import os
+import re
+import string
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(
+    inspect.getfile(inspect.currentframe())))
+sys.path.append(here)
+
+import config as cfg
+import analysis as al
+import clients  # registers the clients and raw loaders in services
+import jsoncodec
+import model as md
+import readers as rd
+import services
+import utils
+import writers as wr
+
+
+def _decode(raw):
+    """Decoded json for raw, None if not json"""
+    try:
+        return jsoncodec.loads(raw)
+    except ValueError:
+        return None
+
+
+def _as_response(svc, raw, decoded):
+    """
+    Response as the parser for svc takes it, from the raw loader
+    registered for svc (see L{services.Service}), or decoded json if none
+    @param raw: response text
+    @param decoded: json decoded from raw, None if not json
+    """
+    if decoded is not None and not decoded:
+        # empty response, also written for failed requests
+        return decoded
+    if raw is None:
+        return decoded if decoded is not None else {}
+    loader = services.get(svc).raw_loader
+    if loader is not None:
+        return loader(raw, decoded)
+    return decoded
+
+
+def load_raw_response(svc, raw):
+    """
+    Responses in a raw response file, as the parser for the service
+    takes them
+    @param svc: service name
+    @param raw: file content
+    @return: list of (position in document, response), with one item
+    unless the document was sent in chunks (see L{model.ChunkedResponse})
+    """
+    decoded = _decode(raw)
+    if (isinstance(decoded, list) and decoded and
+        all(isinstance(item, dict) and sorted(item) == ["offset", "response"]
+            for item in decoded)):
+        responses = []
+        for item in decoded:
+            if isinstance(item["response"], basestring):
+                chraw = item["response"]
+                responses.append((item["offset"], _as_response(
+                    svc, chraw, _decode(chraw))))
+            else:
+                responses.append((item["offset"], _as_response(
+                    svc, None, item["response"])))
+        return responses
+    return [(0, _as_response(svc, raw, decoded))]
+
+
+def reparse_file(task):
+    """
+    Parse the raw response for a document, in a worker process, with a
+    corpus of its own
+    @param task: (file-name, service, raw response file, text or None)
+    @return: file-name, service, annotations as tuples (start, end, surface,
+    fmention, entity label, confidence, sentence number), and the
+    L{model.Entity} objects for them by label, with the categories parsed
+    for the service (their normalized category is worked out in the main
+    corpus, see L{add_to_corpus})
+    """
+    fn, svc, path, text = task
+    cps = md.Corpus(cfg)
+    # the cache file is not written to from several processes
+    cps.categ_cache = None
+    client = services.get(svc).client(cfg)
+    with codecs.open(path, "r", "utf8") as inf:
+        raw = inf.read()
+    normtext = utils.Utils.norm_text(text) if text is not None else None
+    anns = {}
+    try:
+        for offset, response in load_raw_response(svc, raw):
+            chunk = normtext[offset:] if normtext is not None else None
+            anns.update(al.AnnotationParser.parse(
+                fn, client, response, cps, text=chunk, offset=offset) or {})
+    except ValueError, msg:
+        print "\n! Error with file: {}".format(path)
+        print "\n" + msg.message
+        anns = {}
+    if text is not None:
+        utils.Utils.add_sentence_number_to_annots(
+            anns, md.Document(fn, text=text))
+    rows = [(start, end, an.mention.surface, an.fmention, an.enti.link,
+             an.confidence, an.snbr)
+            for (start, end), an in sorted(anns.items())]
+    ents = dict((an.enti.link, an.enti) for an in anns.values())
+    return fn, svc, rows, ents
+
+
+def add_to_corpus(cps, fn, svc, rows, ents, cat_ind):
+    """
+    Add the annotations and entities parsed for a document by
+    L{reparse_file} to a corpus, as L{main} adds them when parsing a
+    response, so that entities get the same categories as in the run
+    @return: hash of L{model.Annotation} by position
+    """
+    for ent in ents.values():
+        cps.merge_entity(ent, svc)
+    anns = {}
+    for start, end, surface, fmention, link, confidence, snbr in rows:
+        mention = cps.add_mention_to_corpus(
+            al.CorpusMgr.create_mention_key(fn, start, end), surface)
+        cps.normalize_entity_categories(link, cat_ind)
+        ann = md.Annotation(mention, cps.entities[link])
+        ann.fmention = fmention
+        ann.confidence = confidence
+        ann.snbr = snbr
+        ann.service = svc
+        anns[(start, end)] = ann
+    return anns
+
+
+def find_tasks(rawdir, svcs, runid, texts):
+    """
+    Tasks for L{reparse_file}, for the raw responses in rawdir for services
+    svcs and run-id runid, sorted by service (in L{config.linker_order})
+    and file-name
+    @param texts: hash of (file-name, text) by file-name without
+    extension, empty if texts not available
+    """
+    fnre = re.compile(r"^(?P<doc>.+)_(?P<svc>{})_{}\.txt$".format(
+        "|".join(re.escape(svc) for svc in svcs), string.zfill(runid, 3)))
+    tasks = []
+    for rawfn in os.listdir(rawdir):
+        match = fnre.match(rawfn)
+        if not match:
+            continue
+        fn, text = texts.get(match.group("doc"), (match.group("doc"), None))
+        tasks.append((fn, match.group("svc"), os.path.join(rawdir, rawfn),
+                      text))
+    return sorted(tasks, key=lambda ta: (cfg.linker_order.index(ta[1]),
+                                         ta[0]))
+
+
+def run_argparse():
+    parser = argparse.ArgumentParser(
+        description="Re-parse stored raw responses into annotations",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("runid",
+                        help="Run-id in the raw response file names")
+    parser.add_argument("-r", "--rawdir", dest="rawdir", default=cfg.resdir,
+                        help="Directory with the raw responses")
+    parser.add_argument("-i", "--input", dest="myinput",
+                        help="Input the responses were obtained for "
+                             "(for sentence numbers, and Babelfy)")
+    parser.add_argument("-o", "--out", dest="myout", default=cfg.outdir,
+                        help="Output directory for annotations")
+    parser.add_argument("-s", "--services", dest="services",
+                        help="Comma-separated services to re-parse "
+                             "(default all found)")
+    parser.add_argument("-c", "--corpus", dest="corpus_name",
+                        default=cfg.cpsname, help="Corpus name")
+    parser.add_argument("-w", "--workers", dest="workers", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Processes to parse with (1 to parse in "
+                             "this process)")
+    return parser.parse_args()
+
+
+def main():
+    print "~~ START: {} ~~".format(time.asctime(time.localtime()))
+    argus = run_argparse()
+    utl = utils.Utils(cfg)
+    utl.setup(outdir=argus.myout)
+    myrunid = utl.read_runid()
+    svcs = (argus.services.split(",") if argus.services
+            else services.names())
+    texts = {}
+    if argus.myinput is not None:
+        for fn, text in rd.create_reader(cfg).iter_read(argus.myinput):
+            texts[os.path.basename(os.path.splitext(fn)[0])] = (fn, text)
+    tasks = find_tasks(argus.rawdir, svcs, argus.runid, texts)
+    if not texts and [ta for ta in tasks if ta[1] == cfg.TNames.BF]:
+        # babelfy mentions are taken from the text
+        print "! Skipping Babelfy responses: input texts needed (-i)"
+        tasks = [ta for ta in tasks if ta[1] != cfg.TNames.BF]
+    print "- Re-parsing {} raw responses with {} workers".format(
+        len(tasks), argus.workers)
+
+    mycps = md.Corpus(cfg, name=argus.corpus_name)
+    cat_ind = utl.load_entity_category_indicators()
+    mywriter = wr.Obj2TsvWriter(cfg)
+    pool = None
+    if argus.workers > 1:
+        pool = multiprocessing.Pool(argus.workers)
+        results = pool.imap(reparse_file, tasks, chunksize=8)
+    else:
+        results = itertools.imap(reparse_file, tasks)
+    written = set()
+    try:
+        for fn, svc, rows, ents in results:
+            anns = add_to_corpus(mycps, fn, svc, rows, ents, cat_ind)
+            if cfg.oneoutforall:
+                mywriter.write_to_single({fn: anns}, svc, mycps,
+                    runid=myrunid, has_categ=cfg.add_categs,
+                    write_header=svc not in written, outdir=argus.myout)
+            else:
+                mywriter.write_to_multi({fn: anns}, svc, mycps,
+                    runid=myrunid, has_categ=cfg.add_categs,
+                    outdir=argus.myout)
+            written.add(svc)
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        utl.cleanup(myrunid)
+
+    print "~~ END: {} ~~".format(time.asctime(time.localtime()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,19 @@
 """Types of data we'll need"""
 
+import array
+from bisect import bisect_right
 import inspect
 import os
 import sys
-
-from nltk import sent_tokenize
+import threading
 
 here = os.path.dirname(os.path.abspath(
     inspect.getfile(inspect.currentframe())))
 sys.path.append(here)
 
+import cache
 import config as cfg
+import services
 import utils
 
 
@@ -21,19 +24,41 @@ class Corpus(object):
     @ivar cf: a config (module or dict)
     @ivar name: corpus name (default from config)
     @ivar entities: L{Entity} dict hashed by label (L{Entity.link})
-    @ivar mentions: L{Mention} dict hashed by mention-key (L{Mention.men_id})
+    @ivar mentions: L{Mention} dict hashed by mention-key (L{Mention.men_id}),
+    a (doc id, start, end) tuple (see L{analysis.CorpusMgr.create_mention_key})
+    @ivar strings: table of interned doc ids and entity labels, so that each
+    is stored once whatever the number of mentions for it (see L{intern})
+    @ivar store: L{AnnotationStore} with the annotations read back from
+    output files (see L{add_annotations}), which co-occurrence counts use
+    @ivar categ_cache: L{cache.CategoryCache} to take entity categories
+    from and store them in, None if not active in config
     """
 
     def __init__(self, cf, name=None):
         self.cf = cf
         self.name = name
-        self.categ_cache = {}
+        self.categ_cache = cache.get_category_cache(cf)
         if self.name is None:
             self.name = self.cf.cpsname
         self.mentions = {}
         self.entities = {}
+        self.strings = {}
+        self.store = AnnotationStore()
+        # entities whose categories changed since their normalized category
+        # was worked out (see L{normalize_entity_categories})
+        self._categs_changed = set()
+        # services whose categories were added to each entity
+        self._categ_svcs = {}
+
+    def intern(self, string):
+        """
+        Return the copy of string in L{strings}, adding it if not there
+        (builtin intern only takes str, and ids and labels are unicode)
+        """
+        return self.strings.setdefault(string, string)
 
-    def add_entity_to_corpus(self, link, svc, annot=None, redo_ents=False):
+    def add_entity_to_corpus(self, link, svc, annot=None, redo_ents=False,
+                             categs=None):
         """
         If entity not added to L{Corpus.entities}, add it
         and add categories for it as well
@@ -41,38 +66,90 @@ class Corpus(object):
         @param svc: svc having produced the annotation on the basis of which
         this entity is being treated.
         @param annot: the annotation we're treating
+        @param categs: categories already parsed for svc, used instead of
+        parsing them from annot (see L{merge_entity})
         @note: annot can be None if no need to use its categs
+        @note: If the entity is in L{categ_cache}, its categories and
+        normalized category are taken from there, and categories are only
+        parsed for services not included in the cached ones
         """
         if link not in self.entities:
+            link = self.intern(link)
             eo = Entity(link)
-            if self.cf.add_categs:
+            svcs = self._categ_svcs.setdefault(link, set())
+            cached = None
+            if self.categ_cache is not None and self.cf.add_categs:
+                cached = self.categ_cache.get(link)
+            if cached is not None:
+                eo.categs.update(cached[0])
+                eo.normcat = cached[1]
+                svcs.update(cached[2])
+            else:
+                self._categs_changed.add(link)
+            if self.cf.add_categs and svc not in svcs:
                 try:
-                    if annot is not None:
-                        eo.categs.update(eo.parse_categs(link, annot, svc))
+                    if categs is None and annot is not None:
+                        categs = eo.parse_categs(link, annot, svc)
+                    if categs is not None:
+                        eo.categs.update(categs)
+                        svcs.add(svc)
+                        self._categs_changed.add(link)
                 except NotImplementedError:
                     pass
             self.entities[link] = eo
         else:
-            if redo_ents:
-                self.entities[link].categs.update(
-                    Entity.parse_categs(link, annot, svc))
+            if redo_ents and svc not in self._categ_svcs.get(link, ()):
+                if categs is None:
+                    categs = Entity.parse_categs(link, annot, svc)
+                self.entities[link].categs.update(categs)
+                self._categ_svcs.setdefault(link, set()).add(svc)
+                self._categs_changed.add(link)
         if svc not in self.entities[link].services:
             self.entities[link].services.append(svc)
 
+    def merge_entity(self, ent, svc):
+        """
+        Add an entity parsed for a service in another corpus (e.g. one
+        filled in another process) as L{add_entity_to_corpus} adds it for
+        an annotation: its categories are taken if the entity is new here,
+        and else only if C{redo_ents} is set for the service in config and
+        they were not taken for it before. Its normalized category is
+        worked out again in this corpus
+        @param ent: the L{Entity}, with the categories parsed for svc only
+        @param svc: service the entity was parsed for
+        @return: the L{Entity} in this corpus
+        """
+        self.add_entity_to_corpus(ent.link, svc, categs=ent.categs,
+                                  redo_ents=self.cf.redo_ents.get(svc, False))
+        return self.entities[ent.link]
+
     def add_mention_to_corpus(self, key, surface):
         """
         Adds a L{Mention} to L{Corpus.mentions} if the mention-key
         is not found there.
-        @param key: a key to hash the mention with
+        @param key: a (doc id, start, end) key to hash the mention with
         @param surface: string representing the mention
-        @note: the key is created elsewhere and L{Mention} attributes
-        must be reconstructed from the key
+        @return: the L{Mention} for key
+        @note: the key is created elsewhere
+        (L{analysis.CorpusMgr.create_mention_key})
         """
-        bits = key.split(u"###")
-        docid, start, end = bits[0], int(bits[1]), int(bits[2])
-        if key not in self.mentions:
+        try:
+            return self.mentions[key]
+        except KeyError:
+            docid, start, end = key
+            key = (self.intern(docid), start, end)
             mt = Mention(key, surface, start, end)
             self.mentions[key] = mt
+            return mt
+
+    def add_annotations(self, docid, anns):
+        """
+        Add the annotations for a doc to L{store}
+        (see L{clients.AnnotationReader.read_file})
+        @param docid: doc (file-name) the annotations are for
+        @param anns: hash of L{Annotation} by position
+        """
+        self.store.append(docid, anns)
 
     def normalize_entity_categories(self, link, indic):
         """
@@ -80,71 +157,96 @@ class Corpus(object):
         Set this category to the entity's "normcat" field
         @param link: label for the entity to work with
         @param indic: hash with info re normalized categ for WP categ labels
+        (see L{utils.Utils.load_entity_category_indicators})
         @note: Category codes are *NOE* (no info), *COD* (concept by default),
         *PER* (Person), *ORG* (Organization), *LOC* (Location),
         *TCO* (DBpedia TopicalConcpet), *COG* (a generic concept, like "Country",
         rather than an instance of a country)
+        @note: The category is only worked out again if the entity's categories
+        changed since the last time (see L{add_entity_to_corpus})
         """
-        # no categ info
         try:
-            if not self.entities[link].categs:
-                self.entities[link].normcat = "NOE"
+            ent = self.entities[link]
         except KeyError:
             return
-        if self.entities[link].normcat in (None, "COD"):
-            # spotlight info
-            try:
-                if "Person" in self.entities[link].categs["dbpediao"]:
-                    self.entities[link].normcat = "PER"
-                    return
-                elif "Organisation" in self.entities[link].categs["dbpediao"]:
-                    self.entities[link].normcat = "ORG"
-                    return
-                elif "Place" in self.entities[link].categs["dbpediao"]:
-                    self.entities[link].normcat = "LOC"
-                    return
-                elif "TopicalConcept" in self.entities[link].categs["dbpediao"]:
-                    self.entities[link].normcat = "TCO"
-                    return
-            except KeyError:
-                pass
-            # wikipedia categs info (TagME, WMiner etc.)
-            # all the indicators are lowercase
-            try:
-                if (link.lower() in indic["PER"]["gene"]
-                    or link.lower() in indic["ORG"]["gene"]
-                    or link.lower() in indic["LOC"]["gene"]):
-                    self.entities[link].normcat = "COG"
-                    return
-                for pi in indic["PER"]["indi"]:
-                    for cat in self.entities[link].categs["wiki"]:
-                        if pi in cat.lower():
-                            hasanti = [i for i in indic["PER"]["anti"]
-                                       if i in cat.lower()]
-                            if len(hasanti) == 0:
-                                self.entities[link].normcat = "PER"
-                                return
-                for oi in indic["ORG"]["indi"]:
-                    for cat in self.entities[link].categs["wiki"]:
-                        if oi in cat.lower():
-                            hasanti = [i for i in indic["ORG"]["anti"]
-                                       if i in cat.lower()]
-                            if len(hasanti) == 0:
-                                self.entities[link].normcat = "ORG"
-                                return
-                for li in indic["LOC"]["indi"]:
-                    for cat in self.entities[link].categs["wiki"]:
-                        if li in cat.lower():
-                            hasanti = [i for i in indic["LOC"]["anti"]
-                                       if i in cat.lower()]
-                            if len(hasanti) == 0:
-                                self.entities[link].normcat = "LOC"
-                                return
-            except KeyError:
-                pass
-            # default
-            self.entities[link].normcat = "COD"
+        # no categ info
+        if not ent.categs:
+            ent.normcat = "NOE"
+        if ent.normcat is not None and (ent.normcat != "COD" or
+                                        link not in self._categs_changed):
+            # categories added since (redo_ents) do not change a normcat
+            # other than COD, but the cache must have them too
+            if link in self._categs_changed:
+                self._categs_changed.discard(link)
+                self._cache_categs(link, ent)
             return
+        self._categs_changed.discard(link)
+        self._find_normcat(link, ent, indic)
+        self._cache_categs(link, ent)
+
+    def _cache_categs(self, link, ent):
+        """Store an entity's categories and normcat in L{categ_cache}"""
+        if self.categ_cache is not None:
+            self.categ_cache.put(link, ent.categs, ent.normcat,
+                                 self._categ_svcs.get(link, ()))
+
+    @staticmethod
+    def _find_normcat(link, ent, indic):
+        """Set normalized category for an entity, see
+        L{normalize_entity_categories}"""
+        # spotlight info
+        try:
+            if "Person" in ent.categs["dbpediao"]:
+                ent.normcat = "PER"
+                return
+            elif "Organisation" in ent.categs["dbpediao"]:
+                ent.normcat = "ORG"
+                return
+            elif "Place" in ent.categs["dbpediao"]:
+                ent.normcat = "LOC"
+                return
+            elif "TopicalConcept" in ent.categs["dbpediao"]:
+                ent.normcat = "TCO"
+                return
+        except KeyError:
+            pass
+        # wikipedia categs info (TagME, WMiner etc.)
+        # all the indicators are lowercase
+        try:
+            lclink = link.lower()
+            if (lclink in indic["PER"]["gene"]
+                or lclink in indic["ORG"]["gene"]
+                or lclink in indic["LOC"]["gene"]):
+                ent.normcat = "COG"
+                return
+            cats = [cat.lower() for cat in ent.categs["wiki"]]
+            for ncat in ("PER", "ORG", "LOC"):
+                if Corpus._has_indicator(cats, indic[ncat]):
+                    ent.normcat = ncat
+                    return
+        except KeyError:
+            pass
+        # default
+        ent.normcat = "COD"
+        return
+
+    @staticmethod
+    def _has_indicator(cats, indic):
+        """
+        True if a category in cats contains an indicator and no anti-indicator
+        @param cats: lowercase categories
+        @param indic: indicators for a normalized category, with the
+        indicators compiled (see L{utils.Utils.compile_indicators})
+        """
+        if "indi_re" not in indic:
+            utils.Utils.compile_indicators(indic)
+        if indic["indi_re"] is None:
+            return False
+        for cat in cats:
+            if (indic["indi_re"].search(cat) and
+                (indic["anti_re"] is None or not indic["anti_re"].search(cat))):
+                return True
+        return False
 
 
 class Token(object):
@@ -153,8 +255,13 @@ class Token(object):
     @ivar surface: the string
     @ivar start: initial character position
     @ivar end: final character position
+    @note: attributes are declared in __slots__ (no per-object dict),
+    since corpora can hold millions of these objects. Same for subclasses,
+    L{Entity} and L{Annotation}
     """
 
+    __slots__ = ("surface", "start", "end")
+
     def __init__(self, surface, start, end):
         self.surface = surface
         self.start = int(start)
@@ -171,17 +278,29 @@ class Token(object):
 class Mention(Token):
     """
     String of characters picked by an EL service to assign an entity to it.
-    @ivar men_id: unique id for the mention.
+    @ivar men_id: unique id for the mention, a (doc id, start, end) tuple.
+    See L{key_string} for its string form
     """
 
+    __slots__ = ("men_id",)
+
     def __init__(self, men_id, surface, start, end):
         super(Mention, self).__init__(surface, start, end)
         self.men_id = men_id
 
+    @staticmethod
+    def format_key(key):
+        """String form for a mention key, for output"""
+        return u"{}###{}###{}".format(*key)
+
+    @property
+    def key_string(self):
+        return Mention.format_key(self.men_id)
+
     def __unicode__(self):
         return u"{0}\t{1}\t{2}\t{3}".format(self.surface,
                                             self.start, self.end,
-                                            self.men_id)
+                                            self.key_string)
 
 
 class Entity(object):
@@ -194,6 +313,8 @@ class Entity(object):
     @note: needs access to a config module or dict
     """
 
+    __slots__ = ("link", "services", "categs", "normcat")
+
     def __init__(self, link, categ_cache=None):
         self.link = link
         self.services = []
@@ -216,20 +337,9 @@ class Entity(object):
         format for the service having annotated it"""
         done = Entity._retrieve_categ_from_cache(link, categ_cache)
         if not done:
-            if service == cfg.TNames.TM:
-                return Entity._parse_tagme_categs(resp)
-            elif service == cfg.TNames.SP:
-                return Entity._parse_spotlight_categs(resp)
-            elif service == cfg.TNames.PS:
-                return Entity._parse_spotstat_categs(resp)
-            elif service == cfg.TNames.WD:
-                return Entity._parse_wminer_categs(resp)
-            elif service == cfg.TNames.AI:
-                return Entity._parse_aida_categs(resp)
-            elif service == cfg.TNames.RA:
-                return Entity._parse_raida_categs(resp)
-            elif service == cfg.TNames.BF:
-                return Entity._parse_babelfy_categs(resp)
+            svc = services.get(service)
+            if svc is not None and svc.categ_parser is not None:
+                return svc.categ_parser(resp)
 
     @staticmethod
     def _parse_tagme_categs(ann):
@@ -288,13 +398,30 @@ class Entity(object):
         return unicode(self).encode("utf8")
 
 
+services.register(cfg.TNames.TM, categ_parser=Entity._parse_tagme_categs)
+services.register(cfg.TNames.SP, categ_parser=Entity._parse_spotlight_categs)
+services.register(cfg.TNames.PS, categ_parser=Entity._parse_spotstat_categs)
+services.register(cfg.TNames.WD, categ_parser=Entity._parse_wminer_categs)
+services.register(cfg.TNames.AI, categ_parser=Entity._parse_aida_categs)
+services.register(cfg.TNames.RA, categ_parser=Entity._parse_raida_categs)
+services.register(cfg.TNames.BF, categ_parser=Entity._parse_babelfy_categs)
+
+
 class Annotation(object):
     """
     Relates a L{Mention} to an L{Entity}
     @type mention: L{Mention}
     @type enti: L{Entity}
+    @ivar fmention: normalized mention (L{utils.Utils.norm_mention})
+    @ivar snbr: number of the sentence the mention is in
+    @ivar normcat: normalized category, when read from a file
+    (see L{clients.AnnotationReader})
     """
 
+    __slots__ = ("mention", "enti", "confidence", "mmconfidence",
+                 "normconfidence", "service", "ent_voters", "mtn_voters",
+                 "fmention", "snbr", "normcat")
+
     def __init__(self, mention, enti):
         self.mention = mention
         self.enti = enti
@@ -304,16 +431,22 @@ class Annotation(object):
         self.service = None
         # ent_voters is a list of services that voted for self.enti
         # when using L{combination.Combiner.Group.select_linkgroup}
-        self.ent_voters = []
+        # (assigned, never appended to, so an empty tuple can be shared)
+        self.ent_voters = ()
         # likewise mtn_voters: list of services that voted for the mention
         # in the selected annotation
-        self.mtn_voters = []
+        self.mtn_voters = ()
+        self.fmention = None
+        self.snbr = None
+        self.normcat = None
 
     def find_sentence_number(self, sentposis):
         """
         Given a hash {(start, end): sentnbr}, return sentnbr for a
         mention-position tuple
         @param sentposis: hash for the sentence positions
+        @note: scans all sentences; to number many annotations in a document
+        use L{Document.assign_sentence_numbers}
         """
         for posi in sentposis:
             if self.mention.start >= posi[0] and self.mention.end <= posi[1]:
@@ -340,6 +473,268 @@ class Annotation(object):
         return unicode(self).encode("utf8")
 
 
+class AnnotationStore(object):
+    """
+    Columnar store for annotations: a typed array (array module) per
+    attribute, with one row per annotation, instead of an L{Annotation}
+    object per annotation. Strings (doc ids, entity labels, services,
+    normalized categories, mentions) are stored as ids in string tables.
+    Bulk operations (L{select}, L{count_by}) are vectorized with numpy when
+    it is installed. L{to_dict} gives back {doc: {(start, end): Annotation}}
+    hashes like the rest of the app uses.
+    @ivar columns: array by column name (see L{COLUMNS})
+    @ivar tables: list of strings by id, for each string table
+    @ivar docrows: list of (first row, row after last) by doc id, for the
+    rows added for the doc each time (see L{append})
+    """
+
+    # name, array typecode, string table (if any). None is -1 for ints
+    # and nan for confidence
+    COLUMNS = (("doc", "i", "doc"),
+               ("start", "i", None),
+               ("end", "i", None),
+               ("entity", "i", "entity"),
+               ("service", "h", "service"),
+               ("confidence", "d", None),
+               ("snbr", "i", None),
+               ("normcat", "h", "normcat"),
+               ("mention", "i", "mention"),
+               ("fmention", "i", "mention"))
+
+    def __init__(self):
+        self.columns = dict((name, array.array(code))
+                            for name, code, table in self.COLUMNS)
+        self._table_of = dict((name, table)
+                              for name, code, table in self.COLUMNS if table)
+        self.tables = dict((table, []) for table in self._table_of.values())
+        self._ids = dict((table, {}) for table in self.tables)
+        self.docrows = {}
+
+    def __len__(self):
+        return len(self.columns["doc"])
+
+    def _string_id(self, table, value):
+        """Id for value in string table, added if not there"""
+        if value is None:
+            return -1
+        try:
+            return self._ids[table][value]
+        except KeyError:
+            self._ids[table][value] = len(self.tables[table])
+            self.tables[table].append(value)
+            return self._ids[table][value]
+
+    def append(self, docid, anns):
+        """
+        Add a row for each annotation in anns, sorted by position
+        @param docid: doc (file-name) the annotations are for
+        @param anns: hash of L{Annotation} by position
+        """
+        cols = self.columns
+        first = len(self)
+        doc = self._string_id("doc", docid)
+        for posi in sorted(anns):
+            an = anns[posi]
+            cols["doc"].append(doc)
+            cols["start"].append(an.mention.start)
+            cols["end"].append(an.mention.end)
+            cols["entity"].append(self._string_id("entity", an.enti.link))
+            cols["service"].append(self._string_id("service", an.service))
+            cols["confidence"].append(
+                float("nan") if an.confidence is None
+                else float(an.confidence))
+            cols["snbr"].append(-1 if an.snbr is None else an.snbr)
+            cols["normcat"].append(self._string_id(
+                "normcat", an.normcat if an.normcat is not None
+                else an.enti.normcat))
+            cols["mention"].append(
+                self._string_id("mention", an.mention.surface))
+            cols["fmention"].append(self._string_id("mention", an.fmention))
+        self.docrows.setdefault(doc, []).append((first, len(self)))
+
+    def extend(self, other):
+        """Add the rows in another store"""
+        for doc, ranges in sorted(other.docrows.items(),
+                                  key=lambda it: it[1][0]):
+            docid = other.tables["doc"][doc]
+            for first, last in ranges:
+                self.append(docid, dict(
+                    (idx, _StoredAnnotation(other, idx))
+                    for idx in xrange(first, last)))
+
+    def get(self, row, column):
+        """Value of column for a row, strings and None resolved"""
+        return self._resolve(column, self.columns[column][row])
+
+    def doc_rows(self, docid):
+        """Row indexes for a doc, in the order they were added"""
+        doc = self._ids["doc"].get(docid)
+        if doc is None:
+            return []
+        return [row for first, last in self.docrows[doc]
+                for row in xrange(first, last)]
+
+    def _ids_for(self, column, values):
+        table = self._ids[self._table_of[column]]
+        return set(table[va] for va in values if va in table)
+
+    def select(self, docs=None, services=None, normcats=None,
+               min_confidence=None, in_sentence=False):
+        """
+        Row indexes for annotations meeting all the conditions given
+        @param docs: doc ids to keep
+        @param services: services to keep
+        @param normcats: normalized categories to keep
+        @param min_confidence: min confidence to keep
+        @param in_sentence: if True, keep annotations with a sentence number
+        @return: sorted sequence of row indexes (numpy array if numpy is
+        installed, else list)
+        """
+        conds = []
+        for column, values in (("doc", docs), ("service", services),
+                               ("normcat", normcats)):
+            if values is not None:
+                conds.append((column, self._ids_for(column, values)))
+        np = utils.get_numpy()
+        if np is not None:
+            mask = np.ones(len(self), dtype=bool)
+            for column, ids in conds:
+                mask &= np.in1d(self.as_numpy(column), list(ids))
+            if min_confidence is not None:
+                # nan (no confidence) compares False
+                with np.errstate(invalid="ignore"):
+                    mask &= self.as_numpy("confidence") >= min_confidence
+            if in_sentence:
+                mask &= self.as_numpy("snbr") >= 0
+            return np.flatnonzero(mask)
+        rows = []
+        cols = self.columns
+        for row in xrange(len(self)):
+            if [column for column, ids in conds
+                    if cols[column][row] not in ids]:
+                continue
+            if (min_confidence is not None and
+                not cols["confidence"][row] >= min_confidence):
+                continue
+            if in_sentence and cols["snbr"][row] < 0:
+                continue
+            rows.append(row)
+        return rows
+
+    def as_numpy(self, column):
+        """
+        Column as a numpy array sharing memory with the store
+        (the store must not grow while the array is used)
+        """
+        np = utils.get_numpy()
+        col = self.columns[column]
+        return np.frombuffer(col, dtype=col.typecode) if len(col) else \
+            np.zeros(0, dtype=col.typecode)
+
+    def count_by(self, column, rows=None):
+        """
+        Number of annotations by value of column
+        @param rows: row indexes to count (default all)
+        @return: hash of counts by value (strings and None resolved)
+        """
+        np = utils.get_numpy()
+        if np is not None and (column in self._table_of or
+                               column == "snbr"):
+            values = self.as_numpy(column)
+            if rows is not None:
+                values = values[np.asarray(rows, dtype=int)]
+            # shift so that -1 (None) is counted too
+            counts = np.bincount(values.astype(int) + 1)
+            return dict((self._resolve(column, idx - 1), int(cnt))
+                        for idx, cnt in enumerate(counts) if cnt)
+        counts = {}
+        col = self.columns[column]
+        for row in (xrange(len(self)) if rows is None else rows):
+            counts[col[row]] = counts.get(col[row], 0) + 1
+        return dict((self._resolve(column, va), cnt)
+                    for va, cnt in counts.items())
+
+    def group_by(self, columns, rows=None):
+        """
+        Row indexes grouped by the values of columns
+        @param columns: tuple of column names
+        @param rows: row indexes to group (default all)
+        @return: hash of row index lists, by tuple of values for columns
+        """
+        groups = {}
+        cols = [self.columns[column] for column in columns]
+        for row in (xrange(len(self)) if rows is None else rows):
+            groups.setdefault(tuple(col[row] for col in cols), []).append(row)
+        return dict((tuple(self._resolve(column, va)
+                           for column, va in zip(columns, ke)), rws)
+                    for ke, rws in groups.items())
+
+    def _resolve(self, column, value):
+        """Value as stored in column to string or None where needed"""
+        if column in self._table_of:
+            return None if value < 0 else \
+                self.tables[self._table_of[column]][value]
+        if column == "snbr":
+            return None if value < 0 else value
+        if column == "confidence":
+            return None if value != value else value
+        return value
+
+    def to_dict(self, rows=None, cpsob=None):
+        """
+        Annotations as {doc: {(start, end): L{Annotation}}}, like
+        L{clients.AnnotationReader} and the parsers give them
+        @param rows: row indexes to include (default all, and then docs
+        without annotations are included too)
+        @param cpsob: L{Corpus} whose entities and mentions to use in the
+        annotations; if None, or not found there, new ones are created
+        """
+        di = {}
+        if rows is None:
+            for doc in self.docrows:
+                di.setdefault(self.tables["doc"][doc], {})
+            rows = xrange(len(self))
+        for row in rows:
+            docid = self.get(row, "doc")
+            start, end = self.get(row, "start"), self.get(row, "end")
+            link = self.get(row, "entity")
+            key = (os.path.splitext(docid)[0], start, end)
+            mention = enti = None
+            if cpsob is not None:
+                mention = cpsob.mentions.get(key)
+                enti = cpsob.entities.get(link)
+            if mention is None:
+                mention = Mention(key, self.get(row, "mention"), start, end)
+            if enti is None:
+                enti = Entity(link)
+                enti.normcat = self.get(row, "normcat")
+            an = Annotation(mention, enti)
+            an.service = self.get(row, "service")
+            an.confidence = self.get(row, "confidence")
+            an.snbr = self.get(row, "snbr")
+            an.normcat = self.get(row, "normcat")
+            an.fmention = self.get(row, "fmention")
+            di.setdefault(docid, {})[(start, end)] = an
+        return di
+
+
+class _StoredAnnotation(object):
+    """
+    A row in an L{AnnotationStore}, with the attributes that
+    L{AnnotationStore.append} reads, to copy rows between stores
+    """
+
+    def __init__(self, store, row):
+        self.mention = Mention(None, store.get(row, "mention"),
+                               store.get(row, "start"), store.get(row, "end"))
+        self.enti = Entity(store.get(row, "entity"))
+        self.service = store.get(row, "service")
+        self.confidence = store.get(row, "confidence")
+        self.snbr = store.get(row, "snbr")
+        self.normcat = store.get(row, "normcat")
+        self.fmention = store.get(row, "fmention")
+
+
 class Document(object):
     """
     Represents and analyzes documents.
@@ -353,7 +748,9 @@ class Document(object):
         self.ftext = kwargs.get('ftext', None)
         if self.ftext is None:
             self.ftext = utils.Utils.norm_text(self.text)
-        self.stposis = self.find_sentence_positions()
+        # sentence positions, found on first use (see L{stposis})
+        self._stposis = None
+        self._sentence_index = None
         # the rest are unused for now (come from previous version)
         self.dname = kwargs.get('dname', None)
         self.page = kwargs.get('page', None)
@@ -364,24 +761,132 @@ class Document(object):
         self.speaker = kwargs.get('speaker', None)
         self.wikiminer_doc_score = float(kwargs.get('wikiminer_doc_score', 0.0))
 
+    @property
+    def stposis(self):
+        """Hash of sentence numbers by position, computed once per document"""
+        if self._stposis is None:
+            self._stposis = self.find_sentence_positions()
+        return self._stposis
+
     def find_sentence_positions(self, txt=None):
         """
         Given normalized text for a document, sentence-split it
         and return hash of sentence numbers by position.
+        Positions are read from the sentence cache if active
+        (see L{cache.SentenceCache}).
         """
         posi2nbr = {}
         if txt is None:
             txt = self.ftext
-        sts = sent_tokenize(txt)
-        nbr = 1
-        end = 0
-        for st in sts:
-            start = self.ftext[end:].find(st) + end
-            end = start + len(st)
-            posi2nbr[(start, end)] = nbr
-            nbr += 1
+        sentcache = cache.get_sentence_cache(cfg)
+        if sentcache is not None:
+            key = sentcache.make_key(txt)
+            spans = sentcache.get(key)
+        else:
+            spans = None
+        if spans is None:
+            spans = []
+            end = 0
+            for st in get_sentence_tokenizer().tokenize(txt):
+                start = txt[end:].find(st) + end
+                end = start + len(st)
+                spans.append((start, end))
+            if sentcache is not None:
+                sentcache.put(key, spans)
+        for nbr, posi in enumerate(spans, 1):
+            posi2nbr[posi] = nbr
         return posi2nbr
 
+    @property
+    def sentence_index(self):
+        """
+        Sentence starts, ends and numbers, as three lists sorted by start
+        (see L{stposis}), for bisect lookups
+        """
+        if self._sentence_index is None:
+            posis = sorted(self.stposis)
+            self._sentence_index = ([posi[0] for posi in posis],
+                                    [posi[1] for posi in posis],
+                                    [self.stposis[posi] for posi in posis])
+        return self._sentence_index
+
+    def find_sentence_number(self, start, end):
+        """
+        Return number for the sentence that contains positions start to end,
+        None if no sentence contains them
+        """
+        starts, ends, nbrs = self.sentence_index
+        idx = bisect_right(starts, start) - 1
+        if idx >= 0 and end <= ends[idx]:
+            return nbrs[idx]
+        return None
+
+    def assign_sentence_numbers(self, anns):
+        """
+        Set the sentence number (snbr) for each L{Annotation} in anns,
+        going through annotations and sentences in a single sorted sweep.
+        snbr is None for annotations not inside a sentence.
+        @param anns: iterable of L{Annotation} for the document
+        """
+        starts, ends, nbrs = self.sentence_index
+        idx = 0
+        for an in sorted(anns, key=lambda an: an.mention.start):
+            while (idx + 1 < len(starts) and
+                   starts[idx + 1] <= an.mention.start):
+                idx += 1
+            if (starts and starts[idx] <= an.mention.start and
+                an.mention.end <= ends[idx]):
+                an.snbr = nbrs[idx]
+            else:
+                an.snbr = None
+
+    def find_chunks(self, max_chars):
+        """
+        Split normalized text for the document into chunks of whole
+        sentences, with up to max_chars characters (a longer sentence is a
+        chunk of its own). Text between chunks is not in any chunk.
+        @return: list of (position in text, chunk text)
+        """
+        chunks = []
+        cstart = cend = None
+        for start, end in sorted(self.stposis):
+            if cstart is not None and end - cstart > max_chars:
+                chunks.append((cstart, self.ftext[cstart:cend]))
+                cstart = None
+            if cstart is None:
+                cstart = start
+            cend = end
+        if cstart is not None:
+            chunks.append((cstart, self.ftext[cstart:cend]))
+        return chunks
+
+
+_sentence_tokenizer = None
+_sentence_tokenizer_lock = threading.Lock()
+
+
+def get_sentence_tokenizer():
+    """
+    NLTK Punkt sentence tokenizer (what C{nltk.sent_tokenize} uses),
+    loaded on first use and then shared in the process
+    """
+    global _sentence_tokenizer
+    with _sentence_tokenizer_lock:
+        if _sentence_tokenizer is None:
+            import nltk.data
+            _sentence_tokenizer = nltk.data.load(
+                "tokenizers/punkt/english.pickle")
+        return _sentence_tokenizer
+
+
+class ChunkedResponse(list):
+    """
+    Client responses for the chunks of a document (see
+    L{Document.find_chunks}), as (position of chunk in document,
+    chunk text, response) tuples
+    """
+    pass
+
 # Tests
 if __name__ == "__main__":
     import readers as rd
@@ -395,7 +900,7 @@ if __name__ == "__main__":
         print "- {}".format(fn)
         # normalized text is created upon instantiation
         dob = Document(fn, text=ds[fn])
-        dob2sents = dob.find_sentence_positions()
+        dob2sents = dob.stposis
         done += 1
         if done == todo:
             break
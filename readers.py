@@ -1,8 +1,13 @@
 """Reads inputs for EL"""
 
 import codecs
+import gzip
+import io
 import os
+import Queue
+import threading
 
+import jsoncodec
 import utils as ut
 
 
@@ -17,27 +22,262 @@ class DefReader(object):
         """
         Returns an id and the text for every element in ipt.
         Creates a random id if just given a text
+        @note: Keeps all the texts in memory, see L{iter_read} for large inputs
+        """
+        return dict(self.iter_read(ipt))
+
+    def iter_read(self, ipt):
+        """
+        Yields an id and the text for every element in ipt, sorted by id
+        for directories. Files are read as they are needed, and up to
+        C{cfg.prefetch} files are read ahead on a background thread, so that
+        memory does not grow with the number of files.
+        Creates a random id if just given a text
         """
         if os.path.isfile(ipt):
             if self.cfg.DBG:
                 print "- Reading {}".format(ipt)
             with codecs.open(ipt, "r", "utf8") as ih:
-                return {ih.name: ih.read()}
+                yield ih.name, ih.read()
         elif os.path.isdir(ipt):
-            fn2txt = {}
             print "-- READING DIR: {}".format(ipt)
-            for fn in os.listdir(ipt):
-                if self.cfg.DBG:
-                    print "- Reading {} ".format(fn)
-                with codecs.open(os.path.join(ipt, fn), "r", "utf8") as ih:
-                    fn2txt[os.path.basename(ih.name)] = ih.read()
-            #TODO should be generator
-            return fn2txt
+            items = self._iter_dir(ipt)
+            prefetch = getattr(self.cfg, "prefetch", 0)
+            if prefetch > 0:
+                items = self._prefetch(items, prefetch)
+            for fn, text in items:
+                yield fn, text
         elif isinstance(ipt, str):
             try:
-                return {self.txtcache[ipt]: ipt}
+                yield self.txtcache[ipt], ipt
             except KeyError:
                 key = ut.Utils.random_id(self.cfg.random_id_length)
                 self.txtcache[ipt] = key
-                return {key: ipt}
+                yield key, ipt
+
+    def _iter_dir(self, ipt):
+        """Yields file-name and text for each file in directory ipt"""
+        for fn in sorted(os.listdir(ipt)):
+            if self.cfg.DBG:
+                print "- Reading {} ".format(fn)
+            with codecs.open(os.path.join(ipt, fn), "r", "utf8") as ih:
+                yield os.path.basename(ih.name), ih.read()
+
+    @staticmethod
+    def _prefetch(items, size):
+        """
+        Yields the elements of items, which a background thread takes
+        from items up to size elements ahead. Errors from items are
+        raised when reaching the element that failed.
+        """
+        queue = Queue.Queue(maxsize=size)
+        stop = threading.Event()
+
+        def put(entry):
+            # time out to notice when the consumer is gone
+            while not stop.is_set():
+                try:
+                    queue.put(entry, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    continue
+            return False
+
+        def fill():
+            try:
+                for item in items:
+                    if not put(("item", item)):
+                        return
+            except Exception, msg:
+                put(("error", msg))
+                return
+            put(("end", None))
+
+        filler = threading.Thread(target=fill, name="prefetch")
+        filler.daemon = True
+        filler.start()
+        try:
+            while True:
+                kind, value = queue.get()
+                if kind == "end":
+                    return
+                if kind == "error":
+                    raise value
+                yield value
+        finally:
+            stop.set()
+            filler.join()
+
+
+class RecordReader(DefReader):
+    """
+    Base for readers of files with one document per line, which yield the
+    documents as lines are read. Files ending in .gz are decompressed as
+    they are read. Subclasses implement L{parse_line}.
+    @ivar opts: reader options (C{cfg.reader}), with the L{DEFAULTS} for
+    the options not set there
+    """
+
+    # options for the id and the text, if not in C{cfg.reader}
+    DEFAULTS = {}
+
+    def __init__(self, cfg):
+        super(RecordReader, self).__init__(cfg)
+        self.opts = dict(self.DEFAULTS)
+        self.opts.update(cfg.reader)
+
+    def iter_read(self, ipt):
+        """
+        Yields an id and the text for every line in file ipt, or in each file
+        in directory ipt (in sorted file-name order).
+        If ipt is a text, works like L{DefReader.iter_read}
+        """
+        if os.path.isfile(ipt):
+            fns = [ipt]
+        elif os.path.isdir(ipt):
+            print "-- READING DIR: {}".format(ipt)
+            fns = [os.path.join(ipt, fn) for fn in sorted(os.listdir(ipt))]
+        else:
+            for fn, text in DefReader.iter_read(self, ipt):
+                yield fn, text
+            return
+        items = self._iter_files(fns)
+        prefetch = getattr(self.cfg, "prefetch", 0)
+        if prefetch > 0:
+            items = self._prefetch(items, prefetch)
+        for fn, text in items:
+            yield fn, text
+
+    @staticmethod
+    def open_file(fn):
+        """Open fn for reading unicode lines, decompressing .gz files"""
+        # only "\n" ends lines, other unicode line breaks are part of texts
+        if fn.endswith(".gz"):
+            return io.TextIOWrapper(io.BufferedReader(gzip.open(fn, "rb")),
+                                    encoding="utf8", newline="\n")
+        return io.open(fn, "r", encoding="utf8", newline="\n")
+
+    def _iter_files(self, fns):
+        for fn in fns:
+            if self.cfg.DBG:
+                print "- Reading {}".format(fn)
+            with self.open_file(fn) as inf:
+                for docid, text in self._iter_records(inf, fn):
+                    yield docid, text
+
+    def _iter_records(self, inf, fn, first=1):
+        """
+        Yields id and text for each line in open file inf. Lines that
+        can't be parsed are skipped with a message
+        @param inf: file opened with L{open_file}
+        @param fn: name of the file
+        @param first: line number for the next line in inf
+        """
+        prefix = os.path.basename(fn).split(".")[0]
+        for nbr, line in enumerate(inf, first):
+            line = line.rstrip("\r\n")
+            if not line.strip():
+                continue
+            try:
+                docid, text = self.parse_line(line)
+            except (ValueError, IndexError, KeyError, TypeError), msg:
+                print "! Skipping line {} in {}: {} {}".format(
+                    nbr, fn, msg.__class__.__name__, msg)
+                continue
+            if docid is None or not unicode(docid).strip():
+                docid = "{}_{}".format(prefix, str(nbr).zfill(6))
+            yield unicode(docid).strip(), text
+
+    def parse_line(self, line):
+        """
+        Return id (None if the line has none) and text for a line
+        @raise ValueError: if line is malformed
+        """
+        raise NotImplementedError
+
+
+class LineReader(RecordReader):
+    """Each line is the text for a document"""
+
+    def parse_line(self, line):
+        return None, line
+
+
+class JsonlReader(RecordReader):
+    """
+    Each line is a json object, with the id and text for a document
+    under the keys given as C{id} and C{text} in C{cfg.reader}
+    """
+
+    DEFAULTS = {"id": "id", "text": "text"}
+
+    def __init__(self, cfg):
+        super(JsonlReader, self).__init__(cfg)
+        for opt in ("id", "text"):
+            key = self.opts[opt]
+            if not isinstance(key, basestring) and not (
+                    opt == "id" and key is None):
+                raise ValueError("JSONL reader option {} must be a key, "
+                                 "not {!r}".format(opt, key))
+
+    def parse_line(self, line):
+        rec = jsoncodec.loads(line)
+        if not isinstance(rec, dict):
+            raise ValueError("not a json object")
+        if self.opts["id"] is None:
+            return None, rec[self.opts["text"]]
+        return rec.get(self.opts["id"]), rec[self.opts["text"]]
+
+
+class TsvReader(RecordReader):
+    """
+    Each line has tab-separated fields, with the id and text for a document
+    in the columns given as C{id} and C{text} in C{cfg.reader}. Columns are
+    numbers (from 0), or names in the header line if C{header} is set.
+    """
+
+    DEFAULTS = {"id": 0, "text": 1}
+
+    def __init__(self, cfg):
+        super(TsvReader, self).__init__(cfg)
+        self.idcol = self.opts["id"]
+        self.txtcol = self.opts["text"]
+
+    def _iter_records(self, inf, fn, first=1):
+        if self.opts.get("header"):
+            header = inf.readline().rstrip("\r\n").split("\t")
+            self.idcol = self._column(self.opts["id"], header)
+            self.txtcol = self._column(self.opts["text"], header)
+            first += 1
+        for docid, text in super(TsvReader, self)._iter_records(
+                inf, fn, first):
+            yield docid, text
+
+    @staticmethod
+    def _column(col, header):
+        """Index for column col, which is a number or a name in header"""
+        if col is None or isinstance(col, int):
+            return col
+        return header.index(col)
+
+    def parse_line(self, line):
+        fields = line.split("\t")
+        if self.idcol is None:
+            return None, fields[self.txtcol]
+        return fields[self.idcol], fields[self.txtcol]
+
 
+def create_reader(cfg):
+    """
+    Reader for the input format in C{cfg.reader}
+    @rtype: L{DefReader}
+    @raise ValueError: if the format is unknown, or its options invalid
+    """
+    readers = {"files": DefReader,
+               "lines": LineReader,
+               "jsonl": JsonlReader,
+               "tsv": TsvReader}
+    fmt = getattr(cfg, "reader", {"format": "files"})["format"]
+    if fmt not in readers:
+        raise ValueError("Unknown reader format: {}".format(fmt))
+    return readers[fmt](cfg)
@@ -1,10 +1,20 @@
 """Classes to run the other modules (input reader, EL clients and output writers)"""
 import codecs
+from collections import deque
+import cPickle
+import functools
+import itertools
+from multiprocessing.pool import ThreadPool
+import os
+import tempfile
 import time
 
 import analysis as al
 import clients
+from config import TNames
 import model as md
+import services
+import throttle
 import utils as ut
 
 
@@ -28,33 +38,11 @@ class RunnerManager(object):
         except AssertionError:
             print "Allowed services: {}".format(
                 ", ".join(self.cfg.activate.keys()))
-        if linker == self.cfg.TNames.TM:
-            client = clients.TagmeClient(self.cfg)
-            runner = TagmeRunner(self.cfg, client, reader, writer)
-        elif linker == self.cfg.TNames.SP:
-            client = clients.SpotlightClient(self.cfg)
-            runner = SpotlightRunner(self.cfg, client, reader, writer)
-        elif linker == self.cfg.TNames.PS:
-            client = clients.SpotstatClient(self.cfg)
-            runner = SpotstatRunner(self.cfg, client, reader, writer)
-        elif linker == self.cfg.TNames.WD:
-            client = clients.WikipediaMinerClientDexter(self.cfg)
-            runner = WikipediaMinerRunner(self.cfg, client, reader, writer)
-        elif linker == self.cfg.TNames.WI:
-            client = clients.WikipediaMinerClientRemote(self.cfg)
-            runner = WikipediaMinerRunner(self.cfg, client, reader, writer)
-        elif linker == self.cfg.TNames.AI:
-            client = clients.AidaClient(self.cfg)
-            runner = AidaRunner(self.cfg, client, reader, writer)
-        elif linker == self.cfg.TNames.RA:
-            client = clients.AidaRemoteClient(self.cfg)
-            runner = AidaRemoteRunner(self.cfg, client, reader, writer)
-        elif linker == self.cfg.TNames.BF:
-            client = clients.BabelfyClient(self.cfg)
-            runner = BabelfyRunner(self.cfg, client, reader, writer)
-        else:
+        svc = services.get(linker)
+        if svc is None or svc.runner is None:
             return False
-        return runner
+        client = svc.client(self.cfg)
+        return svc.runner(self.cfg, client, reader, writer)
 
 
 class DefRunner(object):
@@ -66,6 +54,12 @@ class DefRunner(object):
     @ivar rd: A reader (L{readers}) to give input to client
     @ivar wr: A writer (L{writers}) to post-process responses
     @ivar donefn: hash to keep track of done filenames
+    @ivar retry_queue: (fn, text, L{model.Document}) for the items whose
+    request failed
+    @ivar failed: filenames whose request failed again when retried
+    (see L{run_retry_queue}), which are not recorded in the checkpoint
+    @ivar checkpoint: a L{writers.Checkpoint} to record written items in,
+    if any (see L{use_checkpoint})
     """
 
     def __init__(self, cfg, cl, rd, wr):
@@ -74,74 +68,281 @@ class DefRunner(object):
         self.rd = rd
         self.wr = wr
         self.donefn = {}
+        self.retry_queue = []
+        self.failed = set()
+        self.checkpoint = None
 
-    def _run_one(self, fn, text, cpsob):
+    def use_checkpoint(self, checkpoint):
         """
-        Creates a request for a text, gets response and obtains annotations.
-        @param fn: file-name for text
+        Record the items written by L{write_results} in a checkpoint, and
+        skip the items the checkpoint already has for this runner's service
+        (so that an interrupted run can be resumed, appending to its outputs)
+        @param checkpoint: a L{writers.Checkpoint}
+        """
+        self.checkpoint = checkpoint
+        done = checkpoint.done(self.cl.name)
+        if done:
+            print "-- [{}] Resuming: {} items already done".format(
+                self.cl.name, len(done))
+        for fn in done:
+            self.donefn[fn] = 1
+
+    def _get_response(self, text):
+        """
+        Creates a request for a text and returns the client response.
         @param text: text to do request for
-        @param cpsob: a L{model.Corpus} object
+        @note: called from worker threads when the service has more than one
+        worker in config, so must not modify the corpus or the runner
         """
-        print "- Running file: {}".format(fn),
         pay = self.cl.create_payload(text)
-        print "    Getting response",
         try:
             res = self.cl.get_response(pay)
         except clients.EmptyTextException as e:
             print e.args[0]["message"]
-            return {}, {}
-        time.sleep(self.cfg.waitfor)
-        print "    Parsing annotations"
-        anns = al.AnnotationParser.parse(fn, self.cl, res, cpsob)
+            return {}
+        return res
+
+    def _parse_response(self, fn, text, res, cpsob, offset=0):
+        """
+        Obtains annotations from a client response.
+        @param fn: file-name for text
+        @param text: text the request was done for
+        @param res: the client response
+        @param cpsob: a L{model.Corpus} object
+        @param offset: position of text in the document, if it is a chunk
+        """
+        return al.AnnotationParser.parse(fn, self.cl, res, cpsob,
+                                         offset=offset)
+
+    def _parse_chunked_response(self, fn, text, res, cpsob):
+        """
+        Obtains annotations from a client response, with positions in the
+        document also when the response is for its chunks
+        (see L{_split_text}). Arguments like L{_parse_response}
+        """
+        if not isinstance(res, md.ChunkedResponse):
+            return self._parse_response(fn, text, res, cpsob)
+        anns = {}
+        for offset, chunk, chres in res:
+            anns.update(self._parse_response(fn, chunk, chres, cpsob,
+                                             offset=offset))
+        return anns
+
+    def _split_text(self, dob):
+        """
+        Split a text longer than the max chunk size for the service
+        (C{chunking} in L{config}) into chunks of whole sentences
+        @param dob: L{model.Document} for the text, whose sentence positions
+        are kept for sentence numbers (see L{_annotate})
+        @return: list of (position in normalized text, chunk), or None if
+        text is not to be split
+        """
+        max_chars = self.cfg.params[self.cl.name].get("chunking", {}).get(
+            "max_chars", self.cfg.chunking["max_chars"])
+        if not max_chars or len(dob.ftext) <= max_chars:
+            return None
+        return dob.find_chunks(max_chars)
+
+    def _get_chunked_response(self, chunks):
+        """
+        Responses for each chunk in chunks, one after the other
+        @param chunks: list of (position in text, chunk)
+        @rtype: L{model.ChunkedResponse}
+        """
+        return md.ChunkedResponse(
+            [(offset, chunk, self._get_response(chunk))
+             for offset, chunk in chunks])
+
+    def _iter_inputs(self, items, skips, skip_done=True):
+        """
+        Yields (fn, text, dob) for the inputs to run, leaving out those in the
+        skip list or already done, and stopping at the config limit.
+        dob is a L{model.Document} for the text, used both to split it into
+        chunks and to number sentences, so that it is sentence-split once
+        @param items: iterable of (fn, text), in the order to run them
+        (see L{readers.DefReader.iter_read})
+        @param skips: filenames to skip
+        @param skip_done: if False, items already done are not left out
+        """
+        todo = self.cfg.limit
+        for fn, text in items:
+            if todo <= 0:
+                break
+            if fn in skips:
+                print "Skipping {}".format(repr(fn))
+                continue
+            # done in the run being resumed
+            if skip_done and fn in self.donefn:
+                continue
+            yield fn, text, md.Document(fn, text=text)
+            todo -= 1
+
+    def _iter_responses(self, inputs):
+        """
+        Calls L{_get_response} for each item in inputs and yields
+        (fn, text, dob, getter), in the same order as inputs. Calling getter
+        returns the response, or raises the exception the request raised.
+        Up to C{params[service]["workers"]} requests (see L{config}) are kept
+        in flight at once. With a single worker, the request is only done
+        when the getter is called.
+        Long texts are split into chunks (see L{_split_text}), whose requests
+        are sent concurrently, and their response is a
+        L{model.ChunkedResponse}
+        @param inputs: iterable of (fn, text, dob), see L{_iter_inputs}
+        """
+        workers = self.cfg.params[self.cl.name].get("workers", 1)
+        if workers <= 1:
+            for fn, text, dob in inputs:
+                chunks = self._split_text(dob)
+                if chunks is not None:
+                    yield fn, text, dob, functools.partial(
+                        self._get_chunked_response, chunks)
+                else:
+                    yield fn, text, dob, functools.partial(
+                        self._get_response, dob.ftext)
+            return
+        pool = ThreadPool(workers)
+        pending = deque()
+
+        def gather(jobs):
+            return md.ChunkedResponse(
+                [(offset, chunk, job.get()) for offset, chunk, job in jobs])
+
+        try:
+            for fn, text, dob in inputs:
+                chunks = self._split_text(dob)
+                if chunks is not None:
+                    jobs = [(offset, chunk, pool.apply_async(
+                             self._get_response, (chunk,)))
+                            for offset, chunk in chunks]
+                    getres = functools.partial(gather, jobs)
+                else:
+                    getres = pool.apply_async(self._get_response,
+                                              (dob.ftext,)).get
+                pending.append((fn, text, dob, getres))
+                if len(pending) > workers:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
+        finally:
+            pool.terminate()
+
+    def _read_inputs(self, ipt, skiplist):
+        """
+        Reads the input and the skip list
+        @param ipt: full path to input to run (or text-string to run)
+        @param skiplist: filenames (one per line) to skip, if any
+        @return: generator of (fn, text), which reads texts as needed;
+        set of filenames to skip
+        """
+        items = self.rd.iter_read(ipt)
+        try:
+            skips = set([x.strip() for x in codecs.open(
+                         skiplist, "r", "utf8").readlines()])
+        except IOError:
+            skips = set()
+        return items, skips
+
+    def _annotate(self, fn, text, getres, dob, cpsob, cat_ind):
+        """
+        Gets the response for a text, parses its annotations and adds
+        sentence numbers and normalized categories to them.
+        @param fn: file-name for text
+        @param text: text the request was done for
+        @param getres: callable returning the response (see L{_iter_responses})
+        @param dob: L{model.Document} object for the text
+        @param cpsob: a L{model.Corpus} object
+        @param cat_ind: category indicators
+        (see L{utils.Utils.load_entity_category_indicators})
+        @return: response, annotations; or None if the request failed,
+        in which case the item is added to L{retry_queue}
+        """
+        try:
+            res = getres()
+            anns = self._parse_chunked_response(fn, dob.ftext, res, cpsob)
+        except clients.network_errors(), msg:
+            print "! [{}] Request failed for {}: {} {}".format(
+                self.cl.name, fn, msg.__class__.__name__, msg)
+            self.retry_queue.append((fn, text, dob))
+            return None
+        except ValueError, msg:
+            print "\n! Error with file: {}".format(fn)
+            print "\n" + msg.message
+            res, anns = {}, {}
+        ut.Utils.add_sentence_number_to_annots(anns, dob)
+        for link in [an.enti.link for posi, an in anns.items()]:
+            cpsob.normalize_entity_categories(link, cat_ind)
         return res, anns
 
     def run_all(self, ipt, skiplist, cpsob):
         """
-        Calls L{_run_one} for each item given as input, yielding
+        Gets a response for each item given as input, yielding
         the response, parsed annotations, document object and file name
         @param ipt: full path to input to run (or text-string to run)
         @param skiplist: filenames (one per line) to skip, if any
+        @note: responses are parsed in sorted file-name order, whatever
+        the number of workers for the service, so output does not depend on it
         """
         uts = ut.Utils(self.cfg)
         cat_ind = uts.load_entity_category_indicators()
         #input
-        fn2txt = self.rd.read(ipt)
+        items, skips = self._read_inputs(ipt, skiplist)
         try:
             dispipt = ipt[0:100]
         except IndexError:
             dispipt = ipt
-        try:
-            skips = [x.strip() for x in codecs.open(
-                     skiplist, "r", "utf8").readlines()]
-        except IOError:
-            skips = []
         # run calls
         print "-- [{}] RUNNING COLLECTION: {}, {}".format(self.cl.name, dispipt,
                                                           time.asctime(time.localtime()))
-        dones = 0
-        todo = self.cfg.limit
-        for fn in sorted(fn2txt):
-            if fn in skips:
-                print "Skipping {}".format(repr(fn))
-                continue
-            # create doc objs
-            dob = md.Document(fn, text=fn2txt[fn])
-            dob.find_sentence_positions()
+        for fn, text, dob, getres in self._iter_responses(
+                self._iter_inputs(items, skips)):
+            print "- Running file: {}".format(fn)
             # annots
-            try:
-                res, anns = self._run_one(fn, ut.Utils.norm_text(fn2txt[fn]), cpsob)
-            except ValueError, msg:
-                print "\n! Error with file: {}".format(fn)
-                print "\n" + msg.message
-                res, anns = {}, {}
-            uts.add_sentence_number_to_annots(anns, dob)
-            for link in [an.enti.link for posi, an in anns.items()]:
-                cpsob.normalize_entity_categories(link, cat_ind)
-            dones += 1
+            annotated = self._annotate(fn, text, getres, dob, cpsob, cat_ind)
+            if annotated is None:
+                continue
+            res, anns = annotated
+            yield res, anns, dob, fn
+        for res, anns, dob, fn in self.run_retry_queue(cpsob, cat_ind):
             yield res, anns, dob, fn
 
-            if dones == todo:
-                break
+    def run_retry_queue(self, cpsob, cat_ind):
+        """
+        Runs again the items in L{retry_queue}, once the service's circuit
+        breaker lets requests through, yielding like L{run_all}.
+        Items failing again are yielded with empty response and annotations,
+        added to L{failed}, and their filenames written to a list in the log
+        directory, which is removed if no item failed.
+        @param cpsob: a L{model.Corpus} object
+        @param cat_ind: category indicators
+        """
+        queue, self.retry_queue = self.retry_queue, []
+        failedfn = os.path.join(self.cfg.logdir, "{}_{}_failed.txt".format(
+            cpsob.name, self.cl.name))
+        if queue:
+            print "-- [{}] RETRYING {} FAILED ITEMS, {}".format(
+                self.cl.name, len(queue), time.asctime(time.localtime()))
+            throttle.get_circuit_breaker(self.cfg, self.cl.name).wait()
+            for fn, text, dob, getres in self._iter_responses(queue):
+                print "- Running file again: {}".format(fn)
+                annotated = self._annotate(fn, text, getres, dob, cpsob,
+                                           cat_ind)
+                if annotated is None:
+                    self.failed.add(fn)
+                    annotated = {}, {}
+                res, anns = annotated
+                yield res, anns, dob, fn
+        if self.retry_queue:
+            print "! [{}] {} items failed again, listed in: {}".format(
+                self.cl.name, len(self.retry_queue), failedfn)
+            if not os.path.exists(self.cfg.logdir):
+                os.makedirs(self.cfg.logdir)
+            with codecs.open(failedfn, "w", "utf8") as outf:
+                outf.write("".join([u"{}\n".format(fn)
+                                    for fn, text, dob in self.retry_queue]))
+        elif os.path.exists(failedfn):
+            # the list from an earlier run does not apply to this one
+            os.remove(failedfn)
 
     def write_results(self, res, anns, fn, cpsob, runid="001", outdir=None,
                       outresps=None):
@@ -177,6 +378,130 @@ class DefRunner(object):
                 cpsob, runid=runid, has_categ=self.cfg.add_categs,
                 outdir=outdir)
         self.donefn[fn] = 1
+        # failed items are run again when the run is resumed
+        if self.checkpoint is not None and fn not in self.failed:
+            self.checkpoint.add(self.cl.name, fn)
+
+
+class MultiRunner(object):
+    """
+    Sends each document to all the runners at once, instead of running
+    the whole input with one runner before starting the next one, with
+    the same results as running the runners one after the other.
+    @ivar cfg: Config infos or L{config}
+    @ivar runners: L{DefRunner} objects, in the order their
+    services have in C{cfg.linker_order}
+    """
+
+    def __init__(self, cfg, runners):
+        self.cfg = cfg
+        self.runners = sorted(runners, key=lambda ru:
+                              cfg.linker_order.index(ru.cl.name))
+
+    @staticmethod
+    def _spool(outf, fn, text, dob, getres):
+        """
+        Wait for a response and append it to spool file outf, with the
+        exception raised instead if the request failed
+        """
+        try:
+            entry = (fn, text, dob, getres(), None)
+        except (clients.network_errors() + (ValueError,)), msg:
+            entry = (fn, text, dob, None, msg)
+        cPickle.dump(entry, outf, cPickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def _iter_spooled(inf):
+        """
+        Yields (fn, text, dob, getter) for the responses in spool file inf,
+        in the order they were spooled, like L{DefRunner._iter_responses}
+        """
+        inf.seek(0)
+        while True:
+            try:
+                fn, text, dob, res, error = cPickle.load(inf)
+            except EOFError:
+                return
+            yield fn, text, dob, functools.partial(_spooled, res, error)
+
+    def run_all(self, ipt, skiplist, cpsob):
+        """
+        Yields the runner, response, parsed annotations, document object
+        and file name for each item given as input and runner, in the
+        order L{DefRunner.run_all} gives them for each runner in turn.
+        @param ipt: full path to input to run (or text-string to run)
+        @param skiplist: filenames (one per line) to skip, if any
+        @param cpsob: a L{model.Corpus} object
+        @note: Requests for an item are sent to all services at once. The
+        responses for the first runner are parsed as they come, and those
+        for the others are kept in a temporary file (not in memory), to be
+        parsed once the previous runners are done with the whole input.
+        Categories thus merge across linkers like when running them one
+        after the other (see C{cfg.redo_ents}), and so does the output,
+        if written for each item as it is yielded.
+        """
+        uts = ut.Utils(self.cfg)
+        cat_ind = uts.load_entity_category_indicators()
+        items, skips = self.runners[0]._read_inputs(ipt, skiplist)
+        print "-- [{}] RUNNING COLLECTION: {}, {}".format(
+            ", ".join([ru.cl.name for ru in self.runners]), ipt[0:100],
+            time.asctime(time.localtime()))
+        # items done for each runner in the run being resumed
+        # (see L{DefRunner.use_checkpoint})
+        resumed = [set(ru.donefn) for ru in self.runners]
+        # items not done yet for some runner
+        inputs = ((fn, text, dob) for fn, text, dob
+                  in self.runners[0]._iter_inputs(items, skips,
+                                                  skip_done=False)
+                  if [done for done in resumed if fn not in done])
+        # each runner keeps its own requests in flight, reading ahead of
+        # the others by its number of workers at most. The copies share
+        # the document objects, so a document is sentence-split once
+        copies = itertools.tee(inputs, len(self.runners) + 1)
+        streams = [ru._iter_responses(item for item in copy
+                                      if item[0] not in done)
+                   for ru, copy, done in zip(self.runners, copies[1:],
+                                             resumed)]
+        first = self.runners[0]
+        spools = [tempfile.TemporaryFile() for ru in self.runners[1:]]
+        try:
+            for fn, text, dob in copies[0]:
+                print "- Running file: {}".format(fn)
+                if fn not in resumed[0]:
+                    getres = next(streams[0])[-1]
+                    annotated = first._annotate(fn, text, getres, dob,
+                                                cpsob, cat_ind)
+                    if annotated is not None:
+                        res, anns = annotated
+                        yield first, res, anns, dob, fn
+                for stream, done, spool in zip(streams[1:], resumed[1:],
+                                               spools):
+                    if fn not in done:
+                        self._spool(spool, fn, text, dob, next(stream)[-1])
+            for res, anns, dob, fn in first.run_retry_queue(cpsob, cat_ind):
+                yield first, res, anns, dob, fn
+            for ru, spool in zip(self.runners[1:], spools):
+                print "-- [{}] PARSING RESPONSES, {}".format(
+                    ru.cl.name, time.asctime(time.localtime()))
+                for fn, text, dob, getres in self._iter_spooled(spool):
+                    print "- Running file: {}".format(fn)
+                    annotated = ru._annotate(fn, text, getres, dob, cpsob,
+                                             cat_ind)
+                    if annotated is not None:
+                        res, anns = annotated
+                        yield ru, res, anns, dob, fn
+                for res, anns, dob, fn in ru.run_retry_queue(cpsob, cat_ind):
+                    yield ru, res, anns, dob, fn
+        finally:
+            for spool in spools:
+                spool.close()
+
+
+def _spooled(res, error):
+    """Response read from a spool file, see L{MultiRunner._spool}"""
+    if error is not None:
+        raise error
+    return res
 
 
 class TagmeRunner(DefRunner):
@@ -190,18 +515,13 @@ class SpotlightRunner(DefRunner):
     def __init__(self, cfg, cl, rd, wr):
         super(SpotlightRunner, self).__init__(cfg, cl, rd, wr)
 
-    def _run_one(self, fn, text, cpsob):
+    def _get_response(self, text):
         """
         See L{DefRunner}
         @note: Override since no need to create payload; pyspotlight
         library called by L{clients.SpotlightClient} creates it.
         """
-        print "- Running file: {}".format(fn),
-        print "    Getting response",
-        res = self.cl.get_response(text)
-        print "    Parsing annotations"
-        anns = al.AnnotationParser.parse(fn, self.cl, res, cpsob)
-        return res, anns
+        return self.cl.get_response(text)
 
 
 class SpotstatRunner(DefRunner):
@@ -209,18 +529,13 @@ class SpotstatRunner(DefRunner):
     def __init__(self, cfg, cl, rd, wr):
         super(SpotstatRunner, self).__init__(cfg, cl, rd, wr)
 
-    def _run_one(self, fn, text, cpsob):
+    def _get_response(self, text):
         """
         See L{DefRunner}
         @note: Override since no need to create payload; pyspotlight
         library called by L{clients.SpotlightClient} creates it.
         """
-        print "- Running file: {}".format(fn),
-        print "    Getting response",
-        res = self.cl.get_response(text)
-        print "    Parsing annotations"
-        anns = al.AnnotationParser.parse(fn, self.cl, res, cpsob)
-        return res, anns
+        return self.cl.get_response(text)
 
 
 class WikipediaMinerRunner(DefRunner):
@@ -246,7 +561,12 @@ class BabelfyRunner(DefRunner):
     def __init__(self, cfg, cl, rd, wr):
         super(BabelfyRunner, self).__init__(cfg, cl, rd, wr)
 
-    def _run_one(self, fn, text, cpsob):
+    def _get_response(self, text):
+        """See L{DefRunner}"""
+        pay = self.cl.create_payload(text)
+        return self.cl.get_response(pay)
+
+    def _parse_response(self, fn, text, res, cpsob, offset=0):
         """
         See L{DefRunner}
         @note: Override since need param text passed to
@@ -254,10 +574,15 @@ class BabelfyRunner(DefRunner):
         based on character offsets (the API will not return the mention,
         just the offsets)
         """
-        print "- Running file: {}".format(fn),
-        pay = self.cl.create_payload(text)
-        print "    Getting response",
-        res = self.cl.get_response(pay)
-        print "    Parsing annotations"
-        anns = al.AnnotationParser.parse(fn, self.cl, res, cpsob, text=text)
-        return res, anns
+        return al.AnnotationParser.parse(fn, self.cl, res, cpsob, text=text,
+                                         offset=offset)
+
+
+services.register(TNames.TM, runner=TagmeRunner)
+services.register(TNames.SP, runner=SpotlightRunner)
+services.register(TNames.PS, runner=SpotstatRunner)
+services.register(TNames.WD, runner=WikipediaMinerRunner)
+services.register(TNames.WI, runner=WikipediaMinerRunner)
+services.register(TNames.AI, runner=AidaRunner)
+services.register(TNames.RA, runner=AidaRemoteRunner)
+services.register(TNames.BF, runner=BabelfyRunner)
@@ -0,0 +1,62 @@
+"""
+Time taken to import the app modules, each in a fresh interpreter, and the
+heavy dependencies each import loads. Combination runs (L{main_combine})
+should not load the http clients, NLTK or lxml.
+
+Usage: python bench_import.py [repeats] [module ...]
+"""
+
+import inspect
+import os
+import subprocess
+import sys
+
+
+here = os.path.dirname(
+    os.path.abspath(inspect.getfile(inspect.currentframe())))
+appdir = os.path.abspath(os.path.join(here, os.pardir))
+
+MODULES = ("config", "utils", "model", "analysis", "clients", "combination",
+           "main_combine", "runners", "main")
+HEAVY = ("requests", "spotlight", "nltk", "lxml", "numpy")
+
+# run in the child interpreter: prints seconds for the import, then the
+# heavy modules loaded
+CHILD = """
+import sys, time
+sys.path.insert(0, {appdir!r})
+start = time.time()
+import {module}
+print time.time() - start
+print " ".join(sorted(mod for mod in {heavy!r} if mod in sys.modules))
+"""
+
+
+def time_import(module):
+    """Seconds to import module in a new interpreter, and heavy deps loaded"""
+    out = subprocess.check_output(
+        [sys.executable, "-c", CHILD.format(appdir=appdir, module=module,
+                                            heavy=HEAVY)],
+        cwd=appdir)
+    secs, loaded = out.splitlines()[-2:]
+    return float(secs), loaded.split()
+
+
+def main(repeats=5, modules=MODULES):
+    print "{:<14}{:>10}{:>10}  {}".format("module", "best (s)", "mean (s)",
+                                          "heavy deps loaded")
+    for module in modules:
+        try:
+            results = [time_import(module) for _ in range(repeats)]
+        except subprocess.CalledProcessError:
+            print "{:<14}{:>10}".format(module, "failed")
+            continue
+        times = [secs for secs, loaded in results]
+        print "{:<14}{:>10.3f}{:>10.3f}  {}".format(
+            module, min(times), sum(times) / len(times),
+            ", ".join(results[0][1]) or "-")
+
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    main(repeats, sys.argv[2:] or MODULES)
@@ -0,0 +1,95 @@
+"""
+Time to decode and encode stored raw responses (as written by
+L{writers.DefWriter.write_raw_responses}) with each installed
+L{jsoncodec} backend.
+
+Usage: python bench_json.py [raw_response_dir] [repeats]
+Without a directory, or if it has no json responses, 2000 TagMe-like
+responses are generated.
+"""
+
+import codecs
+import inspect
+import json
+import os
+import random
+import sys
+import time
+
+
+here = os.path.dirname(
+    os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.append(os.path.join(here, os.pardir))
+
+import jsoncodec
+
+
+def read_responses(dr):
+    """Json texts for the raw responses in dr (other responses skipped)"""
+    texts = []
+    for fn in sorted(os.listdir(dr)):
+        if not fn.endswith(".txt"):
+            continue
+        with codecs.open(os.path.join(dr, fn), "r", "utf8") as inf:
+            text = inf.read()
+        try:
+            json.loads(text)
+        except ValueError:
+            continue
+        texts.append(text.encode("utf8"))
+    return texts
+
+
+def make_responses(nbr):
+    """nbr json texts like TagMe responses"""
+    random.seed(7)
+    texts = []
+    for idx in range(nbr):
+        anns = []
+        for start in sorted(random.sample(xrange(5000), 40)):
+            anns.append({
+                "id": random.randrange(10 ** 7),
+                "title": u"Entit\xe9 {}".format(random.randrange(10 ** 5)),
+                "spot": u"mention {}".format(start),
+                "start": start, "end": start + 10,
+                "rho": random.random(), "link_probability": random.random(),
+                "dbpedia_categories": [u"Category {}".format(
+                    random.randrange(1000)) for _ in range(5)]})
+        texts.append(json.dumps({"annotations": anns, "lang": "en",
+                                 "timestamp": "2016-01-01T00:00:00"}))
+    return texts
+
+
+def bench(texts, repeats):
+    """Best seconds to decode and to encode the texts, for current backend"""
+    decode, encode = [], []
+    for _ in range(repeats):
+        start = time.time()
+        objs = [jsoncodec.loads(text) for text in texts]
+        decode.append(time.time() - start)
+        start = time.time()
+        for obj in objs:
+            jsoncodec.dumps(obj)
+        encode.append(time.time() - start)
+    return min(decode), min(encode)
+
+
+def main(dr=None, repeats=3):
+    texts = read_responses(dr) if dr is not None else []
+    if not texts:
+        texts = make_responses(2000)
+    print "{} responses, {:.1f} MB".format(
+        len(texts), sum(len(text) for text in texts) / 1024.0 ** 2)
+    print "{:<12}{:>12}{:>12}".format("backend", "decode (s)", "encode (s)")
+    for name in jsoncodec.BACKENDS:
+        try:
+            jsoncodec.use_backend(name)
+        except ImportError:
+            print "{:<12}{:>12}".format(name, "missing")
+            continue
+        print "{:<12}{:>12.3f}{:>12.3f}".format(name, *bench(texts, repeats))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else None,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 3)
@@ -0,0 +1,97 @@
+"""
+Memory used by annotations read from an annotation file (as output by
+L{writers}), with the slotted L{model} classes and with dict-backed copies
+of them (like before __slots__ were added).
+Each variant runs in its own process, and memory is the increase in
+peak RSS while reading the file.
+
+Usage: python bench_memory.py [annotation_file] [service]
+Without a file, one with 200000 annotations is generated.
+"""
+
+import codecs
+import inspect
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import types
+
+
+here = os.path.dirname(
+    os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.append(os.path.join(here, os.pardir))
+
+import config as cfg
+import model as md
+import clients
+
+
+SLOTTED = ("Token", "Mention", "Entity", "Annotation")
+
+
+def unslot_model():
+    """Replace the slotted classes in L{model} by dict-backed copies"""
+    for name in SLOTTED:
+        cls = getattr(md, name)
+        ns = dict((ke, va) for ke, va in vars(cls).items()
+                  if ke not in ("__slots__", "__dict__", "__weakref__") and
+                  not isinstance(va, types.MemberDescriptorType))
+        # base is looked up in model, already replaced for Mention
+        bases = tuple(getattr(md, base.__name__) if base.__name__ in SLOTTED
+                      else base for base in cls.__bases__)
+        setattr(md, name, type(name, bases, ns))
+
+
+def write_sample(fn, nbr):
+    """Write nbr random annotations to fn, as the writers would"""
+    random.seed(7)
+    with codecs.open(fn, "w", "utf8") as out:
+        for idx in range(nbr):
+            start = random.randrange(5000)
+            out.write(u"\t".join((
+                u"doc{}".format(idx // 50), u"Mention {}".format(idx % 997),
+                unicode(start), unicode(start + 10),
+                u"Entity_{}".format(random.randrange(nbr // 4)),
+                u"tagme", u"0.5", unicode(idx % 40), u"PER")) + u"\n")
+
+
+def measure(fn, svc, slotted, queue):
+    if not slotted:
+        unslot_model()
+    cfg.use_confidence = False
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cps = md.Corpus(cfg, name="bench")
+    annots = clients.AnnotationReader(cfg).read_file(
+        svc, cps, "001", ipt=fn, oneoutforall=True)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    nbr = sum(len(anns) for anns in annots.values())
+    # ru_maxrss is in kilobytes on Linux
+    queue.put((nbr, (after - before) * 1024))
+
+
+def main(fn=None, svc="tagme"):
+    if fn is None:
+        fn = os.path.join(tempfile.mkdtemp(), "bench_tagme_all_001.txt")
+        write_sample(fn, 200000)
+    results = {}
+    for slotted in (False, True):
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=measure,
+                                       args=(fn, svc, slotted, queue))
+        proc.start()
+        results[slotted] = queue.get()
+        proc.join()
+    for slotted, label in ((False, "dict"), (True, "slots")):
+        nbr, used = results[slotted]
+        print "{:6} {:>9} annotations {:>8.1f} MB {:>6.0f} bytes/annotation".format(
+            label, nbr, used / 1024.0 ** 2, used / float(max(nbr, 1)))
+    saved = results[False][1] - results[True][1]
+    print "saved  {:.1f} MB ({:.0%})".format(
+        saved / 1024.0 ** 2, saved / float(max(results[False][1], 1)))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:3])
@@ -0,0 +1,141 @@
+"""
+Checks that a fan-out run (C{fan_out} in config, L{runners.MultiRunner})
+writes the same annotations and raw responses as a run with the linkers
+one after the other. Services are not called: TagMe and Spotlight
+(statistical backend) answer with canned responses, where entities recur
+across documents and Spotlight adds categories (C{redo_ents}).
+
+Usage: python test_fanout.py
+Exits with status 1 and prints the differences if the outputs differ.
+"""
+
+import difflib
+import inspect
+import os
+import shutil
+import sys
+import tempfile
+
+
+here = os.path.dirname(
+    os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.append(os.path.join(here, os.pardir))
+
+import cache
+import clients
+import config as cfg
+import jsoncodec
+import model as md
+import readers as rd
+import runners as rn
+import writers as wr
+
+
+# label: (wikipedia categories for TagMe, DBpedia types for Spotlight)
+ENTITIES = {"Carol": (["Things named Carol"], "DBpedia:Organisation"),
+            "Paris": (["Capitals in Europe"], "DBpedia:Place"),
+            "Bob": (["People from Leeds"], "DBpedia:Person"),
+            "Acme": (["Companies of Leeds"], "")}
+LINKERS = (cfg.TNames.TM, cfg.TNames.PS)
+TEXTS = ["Carol met Bob in Paris.", "Bob works at Acme. Carol too.",
+         "Carol left.", "Acme and Carol went to Paris. Bob stayed.",
+         "Nothing here."]
+# skip list that does not exist (nothing skipped)
+NOSKIP = os.path.join(tempfile.gettempdir(), "test_fanout_noskip")
+
+
+def fake_response(client, text):
+    """Canned response for a text, as a client for service svc gets it"""
+    found = []
+    for label in sorted(ENTITIES):
+        start = text.find(label)
+        while start >= 0:
+            found.append((start, label))
+            start = text.find(label, start + 1)
+    if client.name == cfg.TNames.TM:
+        return {"annotations": [
+            {"title": label, "spot": label, "start": start,
+             "end": start + len(label), "rho": 0.5,
+             "dbpedia_categories": ENTITIES[label][0]}
+            for start, label in sorted(found)]}
+    return {"Resources": [
+        {"@offset": str(start), "@surfaceForm": label,
+         "@URI": cfg.DBPRESPREF + label, "@similarityScore": "0.5",
+         "@types": ENTITIES[label][1]}
+        for start, label in sorted(found)]}
+
+
+def fake_request(client, method, url, **kwargs):
+    payload = kwargs.get("data", kwargs.get("params"))
+    text = payload["text"]
+    if isinstance(text, str):
+        text = text.decode("utf8")
+    return cache.CachedResponse(
+        jsoncodec.dumps(fake_response(client, text)), url=url)
+
+
+def run(indir, outdir, fan_out):
+    """Run the linkers on the files in indir, writing to outdir"""
+    cps = md.Corpus(cfg, name="fanout")
+    rmgr = rn.RunnerManager(cfg)
+    runners = [rmgr.create_runner(linker, rd.DefReader(cfg),
+                                  wr.Obj2TsvWriter(cfg))
+               for linker in LINKERS]
+    if fan_out:
+        multi = rn.MultiRunner(cfg, runners)
+        for runner, resp, anns, dob, fn in multi.run_all(indir, NOSKIP, cps):
+            runner.write_results(resp, anns, fn, cps, 1, outdir=outdir,
+                                 outresps=outdir)
+    else:
+        for runner in runners:
+            for resp, anns, dob, fn in runner.run_all(indir, NOSKIP, cps):
+                runner.write_results(resp, anns, fn, cps, 1, outdir=outdir,
+                                     outresps=outdir)
+
+
+def compare(dir1, dir2):
+    """Differences between the files in two directories, as text lines"""
+    diffs = []
+    fns = sorted(set(os.listdir(dir1)) | set(os.listdir(dir2)))
+    for fn in fns:
+        try:
+            lines1 = open(os.path.join(dir1, fn)).readlines()
+            lines2 = open(os.path.join(dir2, fn)).readlines()
+        except IOError:
+            diffs.append("Only in one run: {}\n".format(fn))
+            continue
+        diffs.extend(difflib.unified_diff(lines1, lines2, fn + " (in turn)",
+                                          fn + " (fan-out)"))
+    return diffs
+
+
+def main():
+    clients.WSClient._request = fake_request
+    tmpdir = tempfile.mkdtemp()
+    try:
+        indir = os.path.join(tmpdir, "input")
+        os.makedirs(indir)
+        for idx, text in enumerate(TEXTS):
+            with open(os.path.join(indir, "doc{}.txt".format(idx)), "w") \
+                    as outf:
+                outf.write(text)
+        cfg.cache = dict(cfg.cache, active=False)
+        cfg.use_categ_cache = False
+        cfg.logdir = os.path.join(tmpdir, "logs")
+        outdirs = []
+        for fan_out in (False, True):
+            outdirs.append(os.path.join(tmpdir, "out{}".format(fan_out)))
+            os.makedirs(outdirs[-1])
+            run(indir, outdirs[-1], fan_out)
+        diffs = compare(*outdirs)
+    finally:
+        shutil.rmtree(tmpdir)
+    if diffs:
+        sys.stdout.writelines(diffs)
+        print "\nFAILED: fan-out output differs"
+        sys.exit(1)
+    print "OK: fan-out output same as with the linkers in turn"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Checks that re-parsing the raw responses of a run (L{main_reparse}) writes
+the same annotations, byte for byte, as the run itself, in this process
+and with a process pool. Services are not called: the run gets the canned
+responses in L{test_fanout}. It is checked with and without C{redo_ents}
+for Spotlight, which changes the categories of the entities TagMe found.
+
+Usage: python test_reparse.py
+Exits with status 1 and prints the differences if the outputs differ.
+"""
+
+import difflib
+import inspect
+import os
+import shutil
+import sys
+import tempfile
+
+
+here = os.path.dirname(
+    os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.append(os.path.join(here, os.pardir))
+
+import clients
+import config as cfg
+import main_reparse
+import model as md
+import readers as rd
+import runners as rn
+import writers as wr
+from test_fanout import LINKERS, NOSKIP, TEXTS, fake_request
+
+
+CPSNAME = "reparse"
+
+
+def run(indir, outdir, rawdir):
+    """Run the linkers in turn on the files in indir, as L{main} does"""
+    cps = md.Corpus(cfg, name=CPSNAME)
+    rmgr = rn.RunnerManager(cfg)
+    for linker in LINKERS:
+        runner = rmgr.create_runner(linker, rd.DefReader(cfg),
+                                    wr.Obj2TsvWriter(cfg))
+        for resp, anns, dob, fn in runner.run_all(indir, NOSKIP, cps):
+            runner.write_results(resp, anns, fn, cps, 1, outdir=outdir,
+                                 outresps=rawdir)
+
+
+def reparse(indir, outdir, rawdir, workers):
+    """Re-parse the raw responses in rawdir with L{main_reparse.main}"""
+    sys.argv = ["main_reparse.py", "1", "-r", rawdir, "-i", indir,
+                "-o", outdir, "-c", CPSNAME, "-w", str(workers)]
+    main_reparse.main()
+    # so that the next run has run-id 1 again
+    os.remove(cfg.runidf)
+
+
+def compare(dir1, dir2, label):
+    """Differences between the files in two directories, as text lines"""
+    diffs = []
+    fns = sorted(set(os.listdir(dir1)) | set(os.listdir(dir2)))
+    for fn in fns:
+        try:
+            lines1 = open(os.path.join(dir1, fn), "rb").readlines()
+            lines2 = open(os.path.join(dir2, fn), "rb").readlines()
+        except IOError:
+            diffs.append("Only in one run ({}): {}\n".format(label, fn))
+            continue
+        diffs.extend(difflib.unified_diff(lines1, lines2, fn + " (run)",
+                                          "{} ({})".format(fn, label)))
+    return diffs
+
+
+def main():
+    clients.WSClient._request = fake_request
+    tmpdir = tempfile.mkdtemp()
+    diffs = []
+    try:
+        indir = os.path.join(tmpdir, "input")
+        os.makedirs(indir)
+        for idx, text in enumerate(TEXTS):
+            with open(os.path.join(indir, "doc{}.txt".format(idx)), "w") \
+                    as outf:
+                outf.write(text)
+        cfg.cache = dict(cfg.cache, active=False)
+        cfg.use_categ_cache = False
+        cfg.logdir = os.path.join(tmpdir, "logs")
+        cfg.runidf = os.path.join(tmpdir, "runid")
+        redo_ents = cfg.redo_ents
+        for redo in (True, False):
+            cfg.redo_ents = dict(redo_ents, **{cfg.TNames.PS: redo})
+            rundir = os.path.join(tmpdir, "run{}".format(redo))
+            rawdir = os.path.join(tmpdir, "raw{}".format(redo))
+            for dn in (rundir, rawdir):
+                os.makedirs(dn)
+            run(indir, rundir, rawdir)
+            for workers in (1, 2):
+                outdir = os.path.join(tmpdir, "reparse{}{}".format(
+                    redo, workers))
+                os.makedirs(outdir)
+                reparse(indir, outdir, rawdir, workers)
+                diffs.extend(compare(rundir, outdir, "redo_ents {}, {} "
+                                     "workers".format(redo, workers)))
+    finally:
+        shutil.rmtree(tmpdir)
+    if diffs:
+        sys.stdout.writelines(diffs)
+        print "\nFAILED: re-parsed output differs"
+        sys.exit(1)
+    print "OK: re-parsed output same as the run's"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Registry of the services: their client, runner, response parser,
+category parser and raw response loader, so that service-specific code
+is found by name.
+Each module registers the parts it defines (L{clients}, L{runners},
+L{analysis}, L{model}) when imported. A new linker is added by defining
+its parts and calling L{register} for them.
+"""
+
+
+class Service(object):
+    """
+    Parts used to call a service and to parse its responses
+    @ivar name: service name (L{config.TNames})
+    @ivar client: client class (L{clients.WSClient} subclass), created with
+    the config
+    @ivar runner: runner class (L{runners.DefRunner} subclass), created with
+    config, client, reader and writer
+    @ivar parser: function parsing a response into annotations, see
+    L{analysis.AnnotationParser.parse}
+    @ivar categ_parser: function parsing an annotation into entity
+    categories, see L{model.Entity.parse_categs}
+    @ivar raw_loader: function turning a stored raw response (see
+    L{writers.DefWriter.write_raw_responses}) back into the response the
+    parser takes, given the response text and its decoded json (None if
+    not json). If None, the parser takes the decoded json
+    (see L{main_reparse})
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.client = None
+        self.runner = None
+        self.parser = None
+        self.categ_parser = None
+        self.raw_loader = None
+
+
+_registry = {}
+
+
+def register(name, **parts):
+    """
+    Register parts for a service, keeping those registered before
+    @param name: service name (L{config.TNames})
+    @param parts: values for the L{Service} attributes (client, runner,
+    parser, categ_parser, raw_loader)
+    """
+    svc = _registry.setdefault(name, Service(name))
+    for part, value in parts.items():
+        if not hasattr(svc, part):
+            raise ValueError("Unknown service part: {}".format(part))
+        setattr(svc, part, value)
+
+
+def get(name):
+    """
+    Service registered for name, None if none
+    @rtype: L{Service}
+    """
+    return _registry.get(name)
+
+
+def names():
+    """Names of the registered services"""
+    return sorted(_registry)
@@ -0,0 +1,262 @@
+"""Control the pace of the requests sent to each service, and their retries"""
+
+import codecs
+import os
+import random
+import threading
+import time
+
+
+class QuotaExceededException(Exception): pass
+
+
+class RateLimiter(object):
+    """
+    Token bucket limiting the requests per second sent to a service,
+    optionally with a daily quota. The rate adapts to the service:
+    it is lowered when the service answers 429 or 503 or when its latency
+    rises, and raised back to max_rps while answers are fine.
+    @ivar max_rps: requests per second allowed by config
+    @ivar rps: current requests per second
+    @ivar burst: max requests sent at once after idle time
+    @ivar daily: max requests per day (None for no quota)
+    @ivar quotafn: file to store the requests done today across runs
+    """
+
+    # when throttled (429, 503) rate is multiplied by this
+    BACKOFF = 0.5
+    # when latency is over LATENCY_FACTOR times its average, rate is
+    # multiplied by LATENCY_BACKOFF
+    LATENCY_FACTOR = 2.0
+    LATENCY_BACKOFF = 0.8
+    # a fine answer adds this part of max_rps to the rate
+    RECOVERY = 0.05
+    # weight of last latency in the average
+    LATENCY_ALPHA = 0.2
+    # rate never goes under this part of max_rps
+    MIN_PART = 0.02
+
+    def __init__(self, max_rps, burst=1, daily=None, quotafn=None):
+        self.max_rps = float(max_rps)
+        self.rps = self.max_rps
+        self.burst = max(1, burst)
+        self.daily = daily
+        self.quotafn = quotafn
+        self._tokens = float(self.burst)
+        self._last = time.time()
+        self._blocked_until = 0.0
+        self._latency = None
+        self._lock = threading.Lock()
+        self._day, self._used = self._read_quota()
+
+    def _read_quota(self):
+        """Requests done today, as stored in L{quotafn}"""
+        today = time.strftime("%Y-%m-%d")
+        if self.quotafn is None or not os.path.exists(self.quotafn):
+            return today, 0
+        with codecs.open(self.quotafn, "r", "utf8") as inf:
+            try:
+                day, used = inf.read().strip().split("\t")
+            except ValueError:
+                return today, 0
+        if day != today:
+            return today, 0
+        return day, int(used)
+
+    def _write_quota(self):
+        if (self.quotafn is None or
+            not os.path.isdir(os.path.dirname(self.quotafn))):
+            return
+        with codecs.open(self.quotafn, "w", "utf8") as outf:
+            outf.write(u"{}\t{}".format(self._day, self._used))
+
+    def acquire(self):
+        """
+        Wait until a request can be sent
+        @raise QuotaExceededException: if the daily quota is used up
+        """
+        with self._lock:
+            if self.daily is not None:
+                today = time.strftime("%Y-%m-%d")
+                if today != self._day:
+                    self._day, self._used = today, 0
+                if self._used >= self.daily:
+                    raise QuotaExceededException(
+                        "{} requests done on {}".format(self._used, self._day))
+                self._used += 1
+                self._write_quota()
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._last) * self.rps)
+            self._last = now
+            # tokens under zero are requests already waiting for their turn
+            self._tokens -= 1
+            wait = max(0.0, -self._tokens / self.rps,
+                       self._blocked_until - now)
+        if wait > 0:
+            time.sleep(wait)
+
+    def record(self, status, latency=None, retry_after=None):
+        """
+        Adapt the rate to an answer from the service
+        @param status: http status for the answer
+        @param latency: seconds the answer took
+        @param retry_after: seconds the service asks to wait, if any
+        """
+        with self._lock:
+            min_rps = self.max_rps * self.MIN_PART
+            if status in (429, 503):
+                self.rps = max(min_rps, self.rps * self.BACKOFF)
+                self._blocked_until = time.time() + (
+                    retry_after if retry_after is not None else 1 / self.rps)
+                return
+            if latency is None:
+                return
+            if self._latency is None:
+                self._latency = latency
+            if latency > self.LATENCY_FACTOR * self._latency:
+                self.rps = max(min_rps, self.rps * self.LATENCY_BACKOFF)
+            else:
+                self.rps = min(self.max_rps,
+                               self.rps + self.max_rps * self.RECOVERY)
+            self._latency = ((1 - self.LATENCY_ALPHA) * self._latency +
+                             self.LATENCY_ALPHA * latency)
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(cfg, service):
+    """
+    Rate limiter for a service, shared by all the clients in the process.
+    Uses C{params[service]["rate"]} in config, or C{waitfor} seconds between
+    requests if the service has no rate. Returns None if neither is set.
+    @rtype: L{RateLimiter}
+    """
+    with _rate_limiters_lock:
+        if service not in _rate_limiters:
+            rate = cfg.params[service].get("rate")
+            if rate is not None:
+                _rate_limiters[service] = RateLimiter(
+                    rate["rps"], burst=rate.get("burst", 1),
+                    daily=rate.get("daily"),
+                    quotafn=os.path.join(cfg.logdir,
+                                         "quota_{}.txt".format(service)))
+            elif cfg.waitfor:
+                _rate_limiters[service] = RateLimiter(1.0 / cfg.waitfor)
+            else:
+                _rate_limiters[service] = None
+        return _rate_limiters[service]
+
+
+class CircuitOpenException(Exception): pass
+
+
+class ServiceUnavailableException(Exception): pass
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with jitter between attempts for a request
+    @ivar attempts: max attempts per request (1 means no retries)
+    @ivar backoff: seconds to wait after the first failure, doubled after
+    each failure
+    @ivar max_backoff: max seconds to wait between attempts
+    """
+
+    # http statuses worth retrying
+    TRANSIENT = (429, 500, 502, 503, 504)
+
+    def __init__(self, attempts=1, backoff=1.0, max_backoff=30.0):
+        self.attempts = max(1, attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, failures):
+        """
+        Seconds to wait after a number of failures ("full jitter", so that
+        concurrent requests don't all come back at the same time)
+        """
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** (failures - 1)))
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to a service after several consecutive failures.
+    Once cooldown seconds have passed, requests are let through again, and
+    a new failure opens the circuit again.
+    @ivar failures: consecutive failures that open the circuit
+    @ivar cooldown: seconds the circuit stays open
+    """
+
+    def __init__(self, failures=5, cooldown=60.0):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._failed = 0
+        self._opened = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        """
+        @raise CircuitOpenException: if requests should not be sent
+        """
+        with self._lock:
+            if (self._opened is not None and
+                time.time() < self._opened + self.cooldown):
+                raise CircuitOpenException(
+                    "{} failures in a row".format(self._failed))
+
+    def success(self):
+        with self._lock:
+            self._failed = 0
+            self._opened = None
+
+    def failure(self):
+        with self._lock:
+            self._failed += 1
+            if self._failed >= self.failures:
+                self._opened = time.time()
+
+    def wait(self):
+        """Wait until the circuit lets requests through"""
+        with self._lock:
+            if self._opened is None:
+                return
+            wait = self._opened + self.cooldown - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def _retry_option(cfg, service, option):
+    """Retry option in config, which can be overridden in service params"""
+    return cfg.params[service].get("retries", {}).get(
+        option, cfg.retries[option])
+
+
+def get_retry_policy(cfg, service):
+    """
+    Retry policy for a service, from C{retries} in config
+    @rtype: L{RetryPolicy}
+    """
+    return RetryPolicy(_retry_option(cfg, service, "attempts"),
+                       _retry_option(cfg, service, "backoff"),
+                       _retry_option(cfg, service, "max_backoff"))
+
+
+def get_circuit_breaker(cfg, service):
+    """
+    Circuit breaker for a service, shared by all the clients in the process
+    @rtype: L{CircuitBreaker}
+    """
+    with _breakers_lock:
+        if service not in _breakers:
+            _breakers[service] = CircuitBreaker(
+                _retry_option(cfg, service, "breaker_failures"),
+                _retry_option(cfg, service, "breaker_cooldown"))
+        return _breakers[service]
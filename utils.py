@@ -3,13 +3,49 @@
 import argparse
 from copy import deepcopy
 import gzip
-from lxml import etree
+import importlib
 import logging
 import os
 import pickle
 import string
 import random
 import re
+import threading
+
+
+class LazyModule(object):
+    """
+    Stands for a module that is only imported when one of its attributes is
+    first used, so that importing our modules does not load heavy
+    dependencies they may not need
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+etree = LazyModule("lxml.etree")
+
+
+def get_numpy():
+    """numpy module if installed, else None (it is optional)"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+# category indicators by indicator file paths, with the files' mtimes
+# (see L{Utils.load_entity_category_indicators})
+_indicators = {}
+_indicators_lock = threading.Lock()
 
 
 class Utils(object):
@@ -47,6 +83,11 @@ class Utils(object):
         parser.add_argument('-s', '--skip_list', dest='myskiplist',
                             default=self.cfg.files2skip,
                             help='File with filenames to skip')
+        parser.add_argument('--resume', dest='resume', metavar='RUNID',
+                            help='Run-id of an interrupted run to resume. '
+                                 'Items in its checkpoint journal (see config) '
+                                 'are skipped and results are appended to its '
+                                 'output files')
         return parser.parse_args()
 
     def setup(self, outdir=None, outresps=None):
@@ -166,9 +207,7 @@ class Utils(object):
         @param andi: annotation dictionary, hashed by position
         @param dob: L{model.Document} object
         """
-        for posi in andi:
-            andi[posi].snbr = \
-                andi[posi].find_sentence_number(dob.stposis)
+        dob.assign_sentence_numbers(andi.values())
         return andi
 
     def load_entity_category_indicators(self):
@@ -178,7 +217,21 @@ class Utils(object):
         Also can creates lemmatized variant for each indicator
         @return: Dict with the following keys:
           - "PER", "ORG", and each of those has in turn "indi", "anti", "gene"
+          (and the compiled indicators, see L{compile_indicators})
+        @note: The indicators are shared in the process (all runners get the
+        same dict), and the files are only parsed again if they changed
+        since they were loaded
         """
+        paths = (self.cfg.perind, self.cfg.orgind, self.cfg.locind)
+        mtimes = tuple(os.path.getmtime(fn) for fn in paths)
+        with _indicators_lock:
+            if paths not in _indicators or _indicators[paths][0] != mtimes:
+                _indicators[paths] = (
+                    mtimes, self._parse_entity_category_indicators())
+            return _indicators[paths][1]
+
+    def _parse_entity_category_indicators(self):
+        """Parse the indicator files, see L{load_entity_category_indicators}"""
         print "Loading category indicators"
         indi = {"PER": {}, "ORG": {}, "LOC": {}}
         pertree = etree.parse(self.cfg.perind)
@@ -199,8 +252,26 @@ class Utils(object):
                                for x in loctree.xpath("//indicator[@active='1']/text()")]
         indi["LOC"]["gene"] = []
         indi["LOC"]["anti"] = []
+        for ncat in indi:
+            self.compile_indicators(indi[ncat])
         return indi
 
+    @staticmethod
+    def compile_indicators(indic):
+        """
+        Add to the indicators for a normalized category a regex matching any
+        of the indicators ("indi_re") and one matching any of the
+        anti-indicators ("anti_re"), None if there are none, so that a
+        category is searched once for all of them. "gene" becomes a set.
+        @param indic: hash with "indi", "anti", "gene" lists
+        """
+        for key in ("indi", "anti"):
+            words = sorted(set(indic[key]), key=len, reverse=True)
+            indic[key + "_re"] = re.compile(u"|".join(
+                re.escape(wd) for wd in words), re.U) if words else None
+        indic["gene"] = set(indic["gene"])
+        return indic
+
     ## OVERLAPPING MENTIONS BY SAME LINKER ##
 
     @staticmethod
@@ -1,11 +1,12 @@
 """Writes EL responses"""
 
 import codecs
-import json
 import os
 import re
 import string
+import threading
 
+import jsoncodec
 import model as md
 
 
@@ -33,11 +34,31 @@ class DefWriter(object):
             print "  - Writing raw response: {}".format(
                 os.path.realpath(outfn))
             with codecs.open(outfn, "w", "utf8") as out:
-                if (isinstance(di[ke], dict) or
+                if isinstance(di[ke], md.ChunkedResponse):
+                    out.write(jsoncodec.dumps(
+                        [{"offset": offset, "response": self._raw(chres)}
+                         for offset, chunk, chres in di[ke]]))
+                elif (isinstance(di[ke], dict) or
                     isinstance(di[ke], list)):
-                    out.write(json.dumps(di[ke]))
-                elif isinstance(di[ke], str):
-                    out.write(di[ke].decode("utf8"))
+                    out.write(jsoncodec.dumps(di[ke]))
+                elif self._raw(di[ke]) is not None:
+                    out.write(self._raw(di[ke]))
+
+    @staticmethod
+    def _raw(res):
+        """
+        Json-serializable form of a client response, None if unknown.
+        Response objects (L{requests.models.Response},
+        L{cache.CachedResponse}) give their content, so that they can be
+        parsed again (see L{main_reparse})
+        """
+        if isinstance(res, (dict, list, unicode)):
+            return res
+        if isinstance(res, str):
+            return res.decode("utf8")
+        if isinstance(getattr(res, "content", None), str):
+            return res.content.decode("utf8", "replace")
+        return None
 
 
 class Dict2TsvWriter(DefWriter):
@@ -233,3 +254,64 @@ class Obj2TsvWriter(Dict2TsvWriter):
                 outlists.append("\t".join(
                     [re.sub("\xef\xbb\xbf", "", item) for item in outlist]))
         return outlists
+
+
+class Checkpoint(object):
+    """
+    Journal of the items whose results have been written in a run, one
+    line per service and item, so that the run can be resumed after a crash.
+    Each line is written to the file at once, so an interrupted run leaves
+    at most an incomplete last line, which is ignored. Lines are synced to
+    disk every C{sync_every} items (see C{checkpoint} in config) and on
+    L{close}.
+    @ivar path: journal file, in the log directory
+    """
+
+    def __init__(self, cfg, cpsname, runid):
+        self.path = os.path.join(cfg.logdir, "{}_checkpoint_{}.txt".format(
+            cpsname, string.zfill(runid, 3)))
+        self.sync_every = cfg.checkpoint["sync_every"]
+        self._done = self._load()
+        self._fd = None
+        self._unsynced = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """Items done by service, as read from the journal"""
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, "rb") as inf:
+            for line in inf:
+                if not line.endswith("\n"):
+                    break
+                svc, fn = line.decode("utf8").rstrip("\n").split("\t", 1)
+                done.setdefault(svc, set()).add(fn)
+        return done
+
+    def done(self, svc):
+        """Items done for a service"""
+        return self._done.get(svc, set())
+
+    def add(self, svc, fn):
+        """Record an item as done for a service"""
+        with self._lock:
+            if self._fd is None:
+                if not os.path.exists(os.path.dirname(self.path)):
+                    os.makedirs(os.path.dirname(self.path))
+                self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND |
+                                   os.O_CREAT, 0644)
+            os.write(self._fd, u"{}\t{}\n".format(svc, fn).encode("utf8"))
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every:
+                os.fsync(self._fd)
+                self._unsynced = 0
+            self._done.setdefault(svc, set()).add(fn)
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.fsync(self._fd)
+                os.close(self._fd)
+                self._fd = None
+                self._unsynced = 0